@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"SMTP Client Benchmarks. The load benchmark runs an in-process sink; others need one at --host:--port."
+
+import sys; sys.dont_write_bytecode = True
+
+import argparse
+import email.mime.text
+import logging
+import smtplib
+import ssl
+import tempfile
+import time
+import tracemalloc
+
+import tornado.gen
+import tornado.ioloop
+
+import smtp
+import smtp_sink
+
+
+CONCURRENCY_LEVELS = [1, 2, 4, 8, 16, 32, 64]
+
+
+# Entry point.
+# ------------------------------------------------------------------------------
+
+def main(args):
+    "Entry point."
+    benchmark = BENCHMARKS[args.benchmark]
+    tornado.ioloop.IOLoop.current().run_sync(lambda: benchmark(args))
+
+
+def get_argument_parser():
+    "Initializes argument parser."
+    parser = argparse.ArgumentParser(description=globals()["__doc__"])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="benchmark to run")
+    parser.add_argument("--host", default="localhost", help="SMTP sink host", metavar="<host>")
+    parser.add_argument("--port", default=1025, help="SMTP sink port", metavar="<port>", type=int)
+    parser.add_argument("--messages", default=1000, help="number of messages", metavar="<n>", type=int)
+    parser.add_argument("--concurrency", default=4, help="concurrent senders and pool size", metavar="<n>", type=int)
+    parser.add_argument("--size", default=10, help="large message size", metavar="<MiB>", type=int)
+    parser.add_argument("--latency", default=0.0, help="sink reply latency", metavar="<seconds>", type=float)
+    parser.add_argument("--failure-rate", default=0.0, help="share of messages the sink rejects", metavar="<rate>", type=float)
+    parser.add_argument("--no-pipelining", action="store_true", help="do not advertise PIPELINING")
+    parser.add_argument("--starttls", action="store_true", help="use STARTTLS with a self-signed certificate")
+    return parser
+
+
+# Helpers.
+# ------------------------------------------------------------------------------
+
+def make_message():
+    "Makes a small notification message."
+    message = email.mime.text.MIMEText("Benchmark notification.")
+    message["Subject"] = "Benchmark"
+    message["From"] = "no-reply@example.org"
+    message["To"] = "player@example.org"
+    return message.as_string()
+
+
+@tornado.gen.coroutine
+def send_unpooled(args, message):
+    "Sends a message over a fresh connection."
+    client = smtp.SMTPAsync()
+    yield client.connect(args.host, args.port)
+    yield client.sendmail("no-reply@example.org", ["player@example.org"], message)
+    yield client.quit()
+
+
+@tornado.gen.coroutine
+def run_senders(message_count, concurrency, send):
+    "Sends messages from concurrent senders. Returns messages per second."
+    remaining = [message_count]
+
+    @tornado.gen.coroutine
+    def sender():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            yield send()
+
+    start_time = time.perf_counter()
+    yield [sender() for _ in range(concurrency)]
+    return message_count / (time.perf_counter() - start_time)
+
+
+def get_percentile(values, percent):
+    "Gets percentile of the sorted values."
+    return values[min(len(values) - 1, int(round(percent / 100.0 * (len(values) - 1))))]
+
+
+# Benchmarks.
+# ------------------------------------------------------------------------------
+
+@tornado.gen.coroutine
+def benchmark_pool(args):
+    "Compares throughput with and without connection pooling."
+    message = make_message()
+    rate = yield run_senders(args.messages, args.concurrency, lambda: send_unpooled(args, message))
+    logging.info("Without pooling: %.1f messages/s.", rate)
+    pool = smtp.SMTPPool(args.host, args.port, max_size=args.concurrency)
+    rate = yield run_senders(args.messages, args.concurrency, lambda: pool.sendmail("no-reply@example.org", ["player@example.org"], message))
+    pool.close()
+    logging.info("With pooling: %.1f messages/s.", rate)
+
+
+@tornado.gen.coroutine
+def benchmark_data(args):
+    "Measures peak memory and throughput of sending large messages."
+    line = b"A line of a large notification with an attachment, .dot-stuffed.\r\n.\r\n"
+    message = line * (args.size * 1024 * 1024 // len(line))
+    # The former DATA encoding, for reference: a full copy per transformation.
+    tracemalloc.start()
+    quoted = smtplib._quote_periods(message)
+    quoted = quoted + b"." + smtp.CRLF
+    del quoted
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    logging.info("Former DATA encoding: %.1f MiB peak.", peak / 1048576.0)
+    client = smtp.SMTPAsync()
+    yield client.connect(args.host, args.port)
+    tracemalloc.start()
+    start_time = time.perf_counter()
+    for _ in range(args.messages):
+        yield client.sendmail("no-reply@example.org", ["player@example.org"], message)
+    elapsed = time.perf_counter() - start_time
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    yield client.quit()
+    logging.info(
+        "Streamed DATA: %.1f MiB peak, %.1f MiB/s.",
+        peak / 1048576.0, args.messages * len(message) / elapsed / 1048576.0,
+    )
+
+
+@tornado.gen.coroutine
+def benchmark_load(args):
+    "Drives pooled clients against an in-process sink at increasing concurrency."
+    with tempfile.TemporaryDirectory() as directory:
+        sink = smtp_sink.SMTPSink(
+            users={"user": "password"},
+            starttls_options=smtp_sink.make_self_signed_certificate(directory) if args.starttls else None,
+            pipelining=not args.no_pipelining,
+            latency=args.latency,
+            failure_rate=args.failure_rate,
+        )
+        port = sink.listen_local()
+        message = make_message()
+        client_ssl_options = {"cert_reqs": ssl.CERT_NONE}
+        for concurrency in CONCURRENCY_LEVELS:
+            pool = smtp.SMTPPool(
+                "127.0.0.1", port, username="user", password="password", starttls=args.starttls,
+                max_size=concurrency, ssl_options=client_ssl_options,
+            )
+            latencies, failures = [], [0]
+
+            @tornado.gen.coroutine
+            def send():
+                start_time = time.perf_counter()
+                try:
+                    yield pool.sendmail("no-reply@example.org", ["player@example.org"], message)
+                except smtplib.SMTPException:
+                    failures[0] += 1
+                latencies.append(time.perf_counter() - start_time)
+
+            rate = yield run_senders(args.messages, concurrency, send)
+            pool.close()
+            latencies.sort()
+            logging.info(
+                "Concurrency %d: %.1f messages/s, p50 %.2fms, p99 %.2fms, %d failures.",
+                concurrency, rate, 1000.0 * get_percentile(latencies, 50), 1000.0 * get_percentile(latencies, 99), failures[0],
+            )
+        sink.stop()
+
+
+BENCHMARKS = {
+    "data": benchmark_data,
+    "load": benchmark_load,
+    "pool": benchmark_pool,
+}
+
+
+# Script entry point.
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO, stream=sys.stderr)
+    sys.exit(main(get_argument_parser().parse_args()))
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"WoT Ideas Benchmarks. Require a running MongoDB."
+
+import sys; sys.dont_write_bytecode = True
+
+import argparse
+import datetime
+import logging
+import multiprocessing
+import pickle
+import random
+import signal
+import socket
+import subprocess
+import time
+import timeit
+
+import bson
+import numpy
+import tornado.gen
+import tornado.httpclient
+import tornado.ioloop
+import tornado.template
+
+import wotideas
+
+
+DATABASE_NAME = "wotideas_benchmark"
+
+
+# Entry point.
+# ------------------------------------------------------------------------------
+
+def main(args):
+    "Entry point."
+    db = wotideas.initialize_database(DATABASE_NAME)
+    tornado.ioloop.IOLoop.current().run_sync(lambda: wotideas.sync_indexes(db))
+    benchmark = BENCHMARKS[args.benchmark]
+    tornado.ioloop.IOLoop.current().run_sync(lambda: benchmark(db, args))
+
+
+def get_argument_parser():
+    "Initializes argument parser."
+    parser = argparse.ArgumentParser(description=globals()["__doc__"])
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS), help="benchmark to run")
+    parser.add_argument("--bets", default=10000, help="number of bets", metavar="<n>", type=int)
+    parser.add_argument("--accounts", default=1000, help="number of accounts", metavar="<n>", type=int)
+    parser.add_argument("--ideas", default=100, help="number of ideas", metavar="<n>", type=int)
+    parser.add_argument("--number", default=100000, help="number of micro-benchmark iterations", metavar="<n>", type=int)
+    parser.add_argument("--repeat", default=10, help="number of measurement repeats", metavar="<n>", type=int)
+    parser.add_argument("--requests", default=5000, help="number of HTTP requests", metavar="<n>", type=int)
+    parser.add_argument("--concurrency", default=32, help="number of concurrent HTTP requests", metavar="<n>", type=int)
+    parser.add_argument("--port", default=8091, help="HTTP port of the benchmarked server", metavar="<port>", type=int)
+    return parser
+
+
+# Helpers.
+# ------------------------------------------------------------------------------
+
+class Timer:
+    "Measures elapsed wall time."
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+
+
+@tornado.gen.coroutine
+def create_accounts(db, count):
+    "Creates benchmark accounts."
+    yield db.accounts.remove({})
+    yield db.accounts.insert([
+        {"_id": account_id, "nickname": "bench{}".format(account_id), "coins": 100.0}
+        for account_id in range(1, count + 1)
+    ])
+
+
+def make_bets(bet_count, account_count):
+    "Makes random bets."
+    return [
+        {"account_id": random.randint(1, account_count), "nickname": "bench", "coins": float(random.randint(1, 20)), "bet": random.random() < 0.5}
+        for _ in range(bet_count)
+    ]
+
+
+# Benchmarks.
+# ------------------------------------------------------------------------------
+
+@tornado.gen.coroutine
+def benchmark_resolve(db, args):
+    "Resolves an idea with many bets."
+    yield create_accounts(db, args.accounts)
+    yield db.events.remove({})
+    yield db.bets.remove({})
+    yield db.prizes.remove({})
+    yield db.resolutions.remove({})
+    now = datetime.datetime.utcnow()
+    bets = make_bets(args.bets, args.accounts)
+    idea_id = yield db.ideas.insert({
+        "title": "Benchmark",
+        "description": ["Benchmark"],
+        "freeze_date": now,
+        "close_date": now,
+        "resolved": False,
+        "status": wotideas.IdeaStatus.CLOSED.value,
+        "pool": wotideas.make_pool(bets),
+    })
+    yield db.bets.insert([dict(bet, idea_id=idea_id) for bet in bets])
+    with Timer() as timer:
+        yield wotideas.resolve_idea(db, idea_id, True, "benchmark")
+    win_count = yield db.events.find({"type": wotideas.SystemEventType.WIN.value}).count()
+    logging.info("Resolved %d bets (%d wins) in %.3fs.", args.bets, win_count, timer.elapsed)
+
+
+@tornado.gen.coroutine
+def create_ideas(db, count, bets_per_idea):
+    "Creates ideas in every status. Legacy embedded bets emulate unmigrated documents."
+    yield db.ideas.remove({})
+    now = datetime.datetime.utcnow()
+    for i in range(count):
+        offset = datetime.timedelta(days=(i % 4 - 2) * 30 + i)
+        bets = make_bets(bets_per_idea, 1000)
+        idea = {
+            "title": "Benchmark idea #{}".format(i),
+            "description": ["Benchmark idea description paragraph."] * 3,
+            "freeze_date": now + offset,
+            "close_date": now + offset + datetime.timedelta(days=15),
+            "resolved": i % 2 == 0,
+            "pool": wotideas.make_pool(bets),
+            "bets": bets,
+        }
+        idea["status"] = wotideas.get_idea_status(idea, now).value
+        yield db.ideas.insert(idea)
+
+
+@tornado.gen.coroutine
+def benchmark_index(db, args):
+    "Measures bytes transferred and render time per idea list page, with and without projection."
+    yield create_ideas(db, args.ideas, args.bets // args.ideas)
+    template = tornado.template.Loader("templates").load("index.html")
+    page_size = wotideas.IndexRequestHandler.PAGE_SIZE
+    for status in (None, "all", "closed", "unresolved"):
+        spec, sort_by, direction = wotideas.get_index_query(status)
+        for label, fields in (("full documents", None), ("projection", wotideas.IDEA_LIST_FIELDS)):
+            total_size = fetch_time = render_time = 0.0
+            for _ in range(args.repeat):
+                with Timer() as fetch_timer:
+                    ideas = yield db.ideas.find(spec, fields).sort([(sort_by, direction), ("_id", direction)]).limit(page_size).to_list(page_size)
+                with Timer() as render_timer:
+                    template.generate(ideas=ideas, after=None, next_cursor=None, path="/", status=status, **get_template_namespace())
+                total_size += sum(len(bson.BSON.encode(idea)) for idea in ideas)
+                fetch_time += fetch_timer.elapsed
+                render_time += render_timer.elapsed
+            logging.info(
+                "/%s, %s: %.1f KiB, fetch %.2fms, render %.2fms per page.",
+                status or "", label, total_size / args.repeat / 1024.0,
+                1000.0 * fetch_time / args.repeat, 1000.0 * render_time / args.repeat,
+            )
+
+
+@tornado.gen.coroutine
+def benchmark_prizes(db, args):
+    "Measures per-account prize computation of winning bets."
+    bets = make_bets(args.bets, args.accounts)
+    account_ids = numpy.array([bet["account_id"] for bet in bets], numpy.int64)
+    stakes = wotideas.to_cents([bet["coins"] for bet in bets])
+    budget = 2 * int(stakes.sum())
+    elapsed = min(timeit.repeat(lambda: wotideas.compute_prizes(account_ids, stakes, budget), number=1, repeat=args.repeat))
+    logging.info("compute_prizes: %.2fms per %d bets.", 1000.0 * elapsed, args.bets)
+    elapsed = min(timeit.repeat(lambda: wotideas.get_prizes(bets, True), number=1, repeat=args.repeat))
+    logging.info("get_prizes: %.2fms per %d bets.", 1000.0 * elapsed, args.bets)
+
+
+@tornado.gen.coroutine
+def benchmark_session(db, args):
+    "Compares session cookie decoding cost."
+    user = wotideas.User(5589968, "benchmark_nickname")
+    session = wotideas.encode_session(user)
+    legacy_session = pickle.dumps(user)
+    logging.info("Session size: %d bytes, legacy session size: %d bytes.", len(session), len(legacy_session))
+    for label, statement in (
+        ("decode_session", lambda: wotideas.decode_session(session)),
+        ("pickle.loads", lambda: pickle.loads(legacy_session)),
+        ("decode_legacy_session", lambda: wotideas.decode_legacy_session(legacy_session)),
+    ):
+        elapsed = min(timeit.repeat(statement, number=args.number, repeat=args.repeat))
+        logging.info("%s: %.3fus per request.", label, 1000000.0 * elapsed / args.number)
+
+
+@tornado.gen.coroutine
+def benchmark_throughput(db, args):
+    "Compares anonymous page throughput of a single process and of a worker per CPU."
+    yield create_ideas(db, args.ideas, args.bets // args.ideas)
+    cpu_count = multiprocessing.cpu_count()
+    if cpu_count == 1:
+        logging.warning("Single CPU: there is no worker per CPU setup to compare with.")
+    for process_count in sorted({1, cpu_count}):
+        server = subprocess.Popen([
+            sys.executable, "wotideas.py",
+            "--port", str(args.port),
+            "--processes", str(process_count),
+            "--database", DATABASE_NAME,
+        ], stderr=subprocess.DEVNULL)
+        try:
+            wait_for_port(args.port)
+            with Timer() as timer:
+                yield fetch_pages(args.port, args.requests, args.concurrency)
+        finally:
+            server.send_signal(signal.SIGTERM)
+            server.wait()
+        logging.info("%d of %d processes: %.0f requests per second.", process_count, cpu_count, args.requests / timer.elapsed)
+
+
+def wait_for_port(port, timeout=10.0):
+    "Waits until the server accepts connections."
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(("localhost", port)).close()
+        except ConnectionRefusedError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+        else:
+            return
+
+
+@tornado.gen.coroutine
+def fetch_pages(port, request_count, concurrency):
+    "Fetches idea list pages with the given number of concurrent clients."
+    client = tornado.httpclient.AsyncHTTPClient(force_instance=True, max_clients=concurrency)
+    urls = ["http://localhost:{}{}".format(port, path) for path in ("/", "/all", "/closed", "/unresolved")]
+    remaining = [request_count]
+
+    @tornado.gen.coroutine
+    def fetch():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            yield client.fetch(urls[remaining[0] % len(urls)])
+
+    try:
+        yield [fetch() for _ in range(concurrency)]
+    finally:
+        client.close()
+
+
+def get_template_namespace():
+    "Gets anonymous template namespace as used by RequestHandler."
+    return {
+        "application_id": wotideas.config.APPLICATION_ID,
+        "balance": None,
+        "current_user": None,
+        "encode_object_id": wotideas.encode_object_id,
+        "format_date": wotideas.format_date,
+        "idea_counts": {},
+        "is_admin": False,
+        "is_idea_closed": wotideas.is_idea_closed,
+        "is_idea_frozen": wotideas.is_idea_frozen,
+        "SystemEventType": wotideas.SystemEventType,
+    }
+
+
+BENCHMARKS = {
+    "index": benchmark_index,
+    "prizes": benchmark_prizes,
+    "resolve": benchmark_resolve,
+    "session": benchmark_session,
+    "throughput": benchmark_throughput,
+}
+
+
+# Script entry point.
+# ------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO, stream=sys.stderr)
+    sys.exit(main(get_argument_parser().parse_args()))
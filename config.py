@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 # coding: utf-8
 
-from email.utils import formataddr
+from email.utils import formataddr, parseaddr
 
 
 ADMIN_ID = set([5589968])
@@ -11,3 +11,8 @@ EMAIL_CALLBACK_TIME = 10000
 FROM = formataddr(("WoT Ideas", "no-reply@wotideas.ru"))
 NO_REPLY_PASS = "qwe123!@#"
 REPLY_TO = formataddr(("WoT Ideas", "inbox@wotideas.ru"))
+SMTP_HOST = "localhost"
+SMTP_PORT = 587
+SMTP_STARTTLS = True
+SMTP_USERNAME = parseaddr(FROM)[1]
+URL = "http://wotideas.ru"
@@ -7,7 +7,10 @@ import socket
 import logging 
 logger = logging.getLogger(__name__)
 from tornado import gen
+from tornado.concurrent import Future
+import collections
 import smtplib
+import time
 import re
 import base64
 import hmac
@@ -24,6 +27,45 @@ errors = {
     501 : 'Syntax error in parameters or arguments'
 }
 CRLF = b'\r\n'
+# A reply ends with the first line that is not a "NNN-" continuation line.
+CONTINUATION_LINE = re.compile(br'\d{3}-')
+DATA_CHUNK_SIZE = 64 * 1024
+
+
+def iter_data_chunks(msg, chunk_size=DATA_CHUNK_SIZE):
+    """Yields dot-stuffed message data terminated with <CRLF>.<CRLF> in chunks of chunk_size."""
+    # Slicing a memoryview copies one chunk at a time rather than the whole message per step.
+    view = memoryview(msg)
+
+    def segments():
+        start = 0
+        if msg[:1] == b'.':
+            yield b'.'
+        while True:
+            pos = msg.find(b'\n.', start)
+            if pos < 0:
+                break
+            yield view[start:pos + 1]
+            yield b'.'
+            start = pos + 1
+        yield view[start:]
+        if msg[-2:] != CRLF:
+            yield CRLF
+        yield b'.' + CRLF
+
+    parts, size = [], 0
+    for segment in segments():
+        while len(segment):
+            part = segment[:chunk_size - size]
+            parts.append(part)
+            size += len(part)
+            segment = segment[len(part):]
+            if size == chunk_size:
+                yield b''.join(parts)
+                parts, size = [], 0
+    if parts:
+        yield b''.join(parts)
+
 
 class SMTPAsync(object):
     file = None
@@ -42,7 +84,7 @@ class SMTPAsync(object):
         self.port = port
 
         if local_hostname: 
-            self.local_hostname = local_hostname 
+            self.local_hostname = local_hostname.encode('ascii') if isinstance(local_hostname, str) else local_hostname
         else:
             fqdn = socket.getfqdn() 
             if '.' in fqdn:
@@ -53,11 +95,14 @@ class SMTPAsync(object):
                     addr = socket.gethostbyname(socket.gethostname())
                 except socket.gaierror: 
                     pass 
-                self.local_hostname = '[%s]' % addr
+                self.local_hostname = ('[%s]' % addr).encode('ascii')
 
     def _get_stream(self, host, port, timeout):
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM, 0)
         self.stream = iostream.IOStream(sock)
+        # Commands and replies are small writes, so Nagle's algorithm would
+        # hold them back until the delayed ACK of the previous one.
+        self.stream.set_nodelay(True)
         self.stream.connect((host, port))
         return self.stream
 
@@ -75,8 +120,10 @@ class SMTPAsync(object):
     def putcmd(self, name, param = None):
 
         # check if we really need to yield here
-        request = b''.join([name,b' ', param, CRLF]) if param else b''.join([name, CRLF])
-        yield self.send(request)
+        yield self.send(self._makecmd(name, param))
+
+    def _makecmd(self, name, param = None):
+        return b''.join([name,b' ', param, CRLF]) if param else b''.join([name, CRLF])
 
 
 
@@ -94,29 +141,23 @@ class SMTPAsync(object):
 
     @gen.coroutine
     def getreply(self):
+        """Reads a whole, possibly multi-line, reply one line at a time."""
+        lines = []
+        try:
+            while True:
+                line = yield self.stream.read_until(b'\n')
+                lines.append(line.rstrip(CRLF))
+                if not CONTINUATION_LINE.match(line):
+                    break
+        except socket.error as e:
+            logger.exception(e)
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        try:
+            code = int(lines[-1][0:3])
+        except ValueError:
+            code = -1
 
-        resp = []
-        while True:
-            try:
-
-                response = yield self.stream.read_until(CRLF)
-
-            except socket.error as e:
-                logger.exception(e)
-                raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
-            resp.append(response[4:])
-            code = response[0:3]
-            try:
-                code= int(code)
-            except ValueError:
-                code = -1
-                break
-
-            if response[3] in b' \r\n':
-                break
-
-
-        msg = b'\n'.join(resp)
+        msg = b'\n'.join(line[4:] for line in lines)
         return (code,msg)
 
     @gen.coroutine
@@ -139,7 +180,7 @@ class SMTPAsync(object):
 
 
     @gen.coroutine
-    def starttls(self):
+    def starttls(self, ssl_options=None):
         #TODO: check how to read the local computer name
         yield self.ehlo_or_helo_if_needed() 
         if not self.has_extn('starttls'): 
@@ -151,7 +192,7 @@ class SMTPAsync(object):
                 raise RuntimeError("No SSL support included in this Python ")
 
             server_hostname = self.host if ssl.HAS_SNI else None
-            self.stream = yield self.stream.start_tls(False, server_hostname = server_hostname)
+            self.stream = yield self.stream.start_tls(False, ssl_options = ssl_options, server_hostname = server_hostname)
             self.helo_resp = None 
             self.ehlo_resp = None 
             self.esmtp_features = {}
@@ -189,7 +230,7 @@ class SMTPAsync(object):
         # all methods.
         for authmethod in authlist:
             if authmethod == AUTH_CRAM_MD5:
-                (code, resp) = yield self.docmd(b'AUTH', AUTH_CRAM_MD5)
+                (code, resp) = yield self.docmd(b'AUTH', AUTH_CRAM_MD5.encode('ascii'))
                 if code == 334:
                     (code, resp) =yield self.docmd(encode_cram_md5(resp, username, password).encode('ascii'))
             elif authmethod == AUTH_PLAIN:
@@ -222,7 +263,7 @@ class SMTPAsync(object):
     @gen.coroutine
     def helo(self, name = None):
 
-        self.putcmd("helo", name or self.local_hostname)
+        yield self.putcmd(b"helo", name or self.local_hostname)
         (code,msg)= yield self.getreply()
         self.helo_resp=msg
         return (code,msg)
@@ -232,7 +273,7 @@ class SMTPAsync(object):
     @gen.coroutine
     def ehlo(self, name=''):
         self.esmtp_features = {}
-        self.putcmd(self.ehlo_msg,  name or self.local_hostname)
+        yield self.putcmd(self.ehlo_msg,  name or self.local_hostname)
         (code, msg) = yield self.getreply()
 
         self.ehlo_resp = msg
@@ -274,11 +315,14 @@ class SMTPAsync(object):
 
     @gen.coroutine
     def mail(self, sender, options=[]):
+        (code, msg) = yield self.docmd(b'mail', self._mail_param(sender, options))
+        return (code, msg)
+
+    def _mail_param(self, sender, options):
         optionlist = ''
         if options and self.does_esmtp:
             optionlist = ' ' + ' '.join(options)
-        (code, msg) = yield self.docmd(b'mail', ('FROM:%s%s' % (smtplib.quoteaddr(sender), optionlist)).encode('ascii'))
-        return (code, msg)
+        return ('FROM:%s%s' % (smtplib.quoteaddr(sender), optionlist)).encode('ascii')
 
     @gen.coroutine
     def rset(self):
@@ -298,11 +342,14 @@ class SMTPAsync(object):
     @gen.coroutine
     def rcpt(self, recip, options=[]):
         """SMTP 'rcpt' command -- indicates 1 recipient for this mail."""
+        code, msg = yield self.docmd(b"rcpt", self._rcpt_param(recip, options))
+        return (code, msg)
+
+    def _rcpt_param(self, recip, options):
         optionlist = ''
         if options and self.does_esmtp:
             optionlist = ' ' + ' '.join(options)
-        code, msg = yield self.docmd(b"rcpt", ("TO:%s%s" % (smtplib.quoteaddr(recip), optionlist)).encode('ascii'))
-        return (code, msg)
+        return ("TO:%s%s" % (smtplib.quoteaddr(recip), optionlist)).encode('ascii')
 
     @gen.coroutine
     def data(self, msg):
@@ -313,17 +360,19 @@ class SMTPAsync(object):
         if code != 354:
             raise smtplib.SMTPDataError(code, repl)
         else:
-            if isinstance(msg, str):
-                msg = smtplib._fix_eols(msg).encode('ascii')
-            q = smtplib._quote_periods(msg)
-            if q[-2:] != CRLF:
-                q = q + CRLF
-            q = q + b"." + CRLF
-            #self.send(q)
-            yield self.send(q)
-            (code, msg) = yield self.getreply()
+            (code, msg) = yield self._data_body(msg)
             return (code, msg)
 
+    @gen.coroutine
+    def _data_body(self, msg):
+        """Streams message data after the server has accepted DATA."""
+        if isinstance(msg, str):
+            msg = smtplib._fix_eols(msg).encode('ascii')
+        for chunk in iter_data_chunks(msg):
+            yield self.send(chunk)
+        (code, msg) = yield self.getreply()
+        return (code, msg)
+
     @gen.coroutine
     def sendmail(self, from_addr, to_addrs, msg, mail_options=[],
                  rcpt_options=[]):
@@ -339,6 +388,25 @@ class SMTPAsync(object):
             for option in mail_options:
                 esmtp_opts.append(option)
 
+        senderrs = {}
+        if isinstance(to_addrs, str):
+            to_addrs = [to_addrs]
+        if self.has_extn('pipelining'):
+            (code, resp) = yield self._sendmail_pipelined(from_addr, to_addrs, msg, esmtp_opts, rcpt_options, senderrs)
+        else:
+            (code, resp) = yield self._sendmail_sequential(from_addr, to_addrs, msg, esmtp_opts, rcpt_options, senderrs)
+        if code != 250:
+            if code == 421:
+                self.close()
+            else:
+                yield self._rset()
+            raise smtplib.SMTPDataError(code, resp)
+        #if we got here then somebody got our mail
+        return senderrs
+
+    @gen.coroutine
+    def _sendmail_sequential(self, from_addr, to_addrs, msg, esmtp_opts, rcpt_options, senderrs):
+        """Sends the envelope one command per round trip. Returns the final DATA reply."""
         (code, resp) = yield self.mail(from_addr, esmtp_opts)
         if code != 250:
             if code == 421:
@@ -346,9 +414,6 @@ class SMTPAsync(object):
             else:
                 yield self._rset()
             raise smtplib.SMTPSenderRefused(code, resp, from_addr)
-        senderrs = {}
-        if isinstance(to_addrs, str):
-            to_addrs = [to_addrs]
         for each in to_addrs:
             (code, resp) = yield self.rcpt(each, rcpt_options)
             if (code != 250) and (code != 251):
@@ -361,14 +426,48 @@ class SMTPAsync(object):
             yield self._rset()
             raise smtplib.SMTPRecipientsRefused(senderrs)
         (code, resp) =  yield self.data(msg)
-        if code != 250:
+        return (code, resp)
+
+    @gen.coroutine
+    def _sendmail_pipelined(self, from_addr, to_addrs, msg, esmtp_opts, rcpt_options, senderrs):
+        """Sends MAIL, RCPT and DATA in one batch (RFC 2920). Returns the final DATA reply."""
+        commands = [self._makecmd(b'mail', self._mail_param(from_addr, esmtp_opts))]
+        commands.extend(self._makecmd(b'rcpt', self._rcpt_param(each, rcpt_options)) for each in to_addrs)
+        commands.append(self._makecmd(b'data'))
+        yield self.send(b''.join(commands))
+        # Replies come back in command order. The server closes the connection after 421.
+        (code, resp) = yield self.getreply()
+        if code == 421:
+            self.close()
+            raise smtplib.SMTPSenderRefused(code, resp, from_addr)
+        mail_reply = (code, resp)
+        for each in to_addrs:
+            (code, resp) = yield self.getreply()
+            if (code != 250) and (code != 251):
+                senderrs[each] = (code, resp)
             if code == 421:
                 self.close()
-            else:
-                yield self._rset()
-            raise smtplib.SMTPDataError(code, resp)
-        #if we got here then somebody got our mail
-        return senderrs
+                raise smtplib.SMTPRecipientsRefused(senderrs)
+        (code, resp) = yield self.getreply()
+        if code == 421:
+            return (code, resp)
+        data_reply = (code, resp)
+        refused = mail_reply[0] != 250 or len(senderrs) == len(to_addrs)
+        if refused and data_reply[0] == 354:
+            # DATA got accepted anyway, so end it with an empty message that the server must reject.
+            yield self.send(b"." + CRLF)
+            yield self.getreply()
+        if mail_reply[0] != 250:
+            yield self._rset()
+            raise smtplib.SMTPSenderRefused(mail_reply[0], mail_reply[1], from_addr)
+        if len(senderrs) == len(to_addrs):
+            # the server refused all our recipients
+            yield self._rset()
+            raise smtplib.SMTPRecipientsRefused(senderrs)
+        if data_reply[0] != 354:
+            return data_reply
+        (code, resp) = yield self._data_body(msg)
+        return (code, resp)
 
 
     @gen.coroutine
@@ -381,5 +480,121 @@ class SMTPAsync(object):
         self.stream = None
 
 
+class SMTPPool(object):
+    """Bounded pool of connected, authenticated SMTPAsync clients."""
+
+    def __init__(self, host, port=0, username=None, password=None, starttls=False,
+                 max_size=4, max_idle_time=60.0, local_hostname=None, ssl_options=None):
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.starttls = starttls
+        self.ssl_options = ssl_options
+        self.max_size = max_size
+        self.max_idle_time = max_idle_time
+        self.local_hostname = local_hostname
+        self._idle = collections.deque()  # (client, released at), most recent on the right
+        self._size = 0  # idle, borrowed and connecting clients
+        self._waiters = collections.deque()
+
+    @gen.coroutine
+    def acquire(self):
+        """Borrows a client, waiting while the pool is exhausted. Idle clients get RSET as a health check."""
+        while True:
+            self._evict_idle()
+            while self._idle:
+                client, _ = self._idle.pop()
+                if (yield self._check(client)):
+                    return client
+                self._discard(client)
+            if self._size < self.max_size:
+                self._size += 1
+                try:
+                    client = yield self._connect()
+                except Exception:
+                    self._size -= 1
+                    self._notify()
+                    raise
+                return client
+            waiter = Future()
+            self._waiters.append(waiter)
+            yield waiter
+
+    def release(self, client, reusable=True):
+        """Gives a borrowed client back to the pool."""
+        if reusable and client.stream is not None and not client.stream.closed():
+            self._idle.append((client, time.time()))
+        else:
+            self._discard(client)
+        self._notify()
+
+    @gen.coroutine
+    def sendmail(self, from_addr, to_addrs, msg, mail_options=[], rcpt_options=[]):
+        """Sends a message over a pooled connection."""
+        client = yield self.acquire()
+        try:
+            senderrs = yield client.sendmail(from_addr, to_addrs, msg, mail_options, rcpt_options)
+        except (smtplib.SMTPSenderRefused, smtplib.SMTPRecipientsRefused, smtplib.SMTPDataError):
+            # The session has been reset or closed by sendmail already.
+            self.release(client)
+            raise
+        except Exception:
+            self.release(client, reusable=False)
+            raise
+        self.release(client)
+        return senderrs
+
+    def close(self):
+        """Closes idle clients. Borrowed ones are closed on release."""
+        while self._idle:
+            client, _ = self._idle.pop()
+            self._discard(client)
+
+    @gen.coroutine
+    def _connect(self):
+        client = SMTPAsync(local_hostname=self.local_hostname)
+        try:
+            (code, msg) = yield client.connect(self.host, self.port)
+            if code != 220:
+                raise smtplib.SMTPConnectError(code, msg)
+            if self.starttls:
+                yield client.starttls(self.ssl_options)
+            if self.username:
+                yield client.login(self.username, self.password)
+        except Exception:
+            if client.stream is not None:
+                client.close()
+            raise
+        return client
+
+    @gen.coroutine
+    def _check(self, client):
+        try:
+            (code, msg) = yield client.rset()
+        except Exception:
+            logger.debug("Pooled SMTP connection is broken.", exc_info=True)
+            return False
+        return code == 250
+
+    def _evict_idle(self):
+        deadline = time.time() - self.max_idle_time
+        while self._idle and self._idle[0][1] < deadline:
+            client, _ = self._idle.popleft()
+            self._discard(client)
+
+    def _discard(self, client):
+        self._size -= 1
+        if client.stream is not None:
+            client.close()
+
+    def _notify(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+
 class SMTPAsyncException(Exception):
     pass
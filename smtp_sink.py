@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"In-process asynchronous SMTP server stand-in for tests and benchmarks."
+
+import base64
+import collections
+import hmac
+import os
+import random
+import re
+import subprocess
+import time
+
+import tornado.concurrent
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+
+
+CRLF = b"\r\n"
+
+Message = collections.namedtuple("Message", ["sender", "recipients", "data"])
+
+
+def make_self_signed_certificate(directory):
+    "Generates a self-signed localhost certificate with openssl. Returns server SSL options."
+    certfile, keyfile = os.path.join(directory, "cert.pem"), os.path.join(directory, "key.pem")
+    subprocess.check_call(
+        ["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-days", "1",
+         "-subj", "/CN=localhost", "-keyout", keyfile, "-out", certfile],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return {"certfile": certfile, "keyfile": keyfile}
+
+
+class SMTPSink(tornado.tcpserver.TCPServer):
+    "SMTP server stand-in that keeps received messages in memory."
+
+    def __init__(self, users=None, starttls_options=None, pipelining=True, latency=0.0, failure_rate=0.0):
+        super().__init__()
+        self.users = users or {}  # username -> password; authentication is required when set
+        self.starttls_options = starttls_options  # server SSL options; STARTTLS is offered when set
+        self.pipelining = pipelining
+        self.latency = latency  # seconds before each reply
+        self.failure_rate = failure_rate  # share of messages rejected with 451
+        self.messages = []
+
+    def listen_local(self):
+        "Listens on a random local port. Returns the port."
+        sockets = tornado.netutil.bind_sockets(0, "127.0.0.1")
+        self.add_sockets(sockets)
+        return sockets[0].getsockname()[1]
+
+    @tornado.gen.coroutine
+    def handle_stream(self, stream, address):
+        stream.set_nodelay(True)
+        try:
+            yield SMTPSession(self, stream).run()
+        except tornado.iostream.StreamClosedError:
+            pass
+
+
+class SMTPSession:
+    "Single SMTP connection."
+
+    def __init__(self, sink, stream):
+        self.sink = sink
+        self.stream = stream
+        self.is_tls = False
+        self.username = None
+        self.reset()
+
+    def reset(self):
+        "Resets mail transaction."
+        self.sender = None
+        self.recipients = []
+
+    @tornado.gen.coroutine
+    def run(self):
+        "Serves commands until the client quits."
+        self.reply(220, "sink ESMTP")
+        while not self.stream.closed():
+            line = yield self.stream.read_until(CRLF)
+            command, _, argument = line[:-2].decode("utf-8", "replace").partition(" ")
+            handler = getattr(self, "do_" + command.lower(), None) if command.isalpha() else None
+            if handler is None:
+                self.reply(502, "Command not implemented")
+                continue
+            yield handler(argument)
+
+    def reply(self, code, *lines):
+        "Sends a possibly multi-line reply after the configured latency without blocking the session."
+        data = self.format_reply(code, lines)
+        if self.sink.latency:
+            tornado.ioloop.IOLoop.current().call_later(self.sink.latency, self.write, data)
+        else:
+            self.write(data)
+
+    @tornado.gen.coroutine
+    def reply_now(self, code, *lines):
+        "Sends a reply after the configured latency and waits for it to be written."
+        if self.sink.latency:
+            delay = tornado.concurrent.Future()
+            tornado.ioloop.IOLoop.current().call_later(self.sink.latency, delay.set_result, None)
+            yield delay
+        yield self.stream.write(self.format_reply(code, lines))
+
+    def format_reply(self, code, lines):
+        "Formats reply lines."
+        lines = lines or ("",)
+        return "".join(
+            "{}{}{}\r\n".format(code, "-" if i < len(lines) - 1 else " ", line) for i, line in enumerate(lines)
+        ).encode("utf-8")
+
+    def write(self, data):
+        "Writes to the stream unless the client has gone."
+        if not self.stream.closed():
+            self.stream.write(data)
+
+    @tornado.gen.coroutine
+    def challenge(self, text):
+        "Sends an AUTH challenge and reads the response."
+        self.reply(334, text)
+        line = yield self.stream.read_until(CRLF)
+        return base64.b64decode(line[:-2])
+
+    # Commands.
+    # --------------------------------------------------------------------------
+
+    @tornado.gen.coroutine
+    def do_helo(self, argument):
+        self.reset()
+        self.reply(250, "sink")
+
+    @tornado.gen.coroutine
+    def do_ehlo(self, argument):
+        self.reset()
+        features = ["sink", "SIZE 52428800", "8BITMIME"]
+        if self.sink.pipelining:
+            features.append("PIPELINING")
+        if self.sink.starttls_options and not self.is_tls:
+            features.append("STARTTLS")
+        if self.sink.users:
+            features.append("AUTH PLAIN LOGIN CRAM-MD5")
+        self.reply(250, *features)
+
+    @tornado.gen.coroutine
+    def do_starttls(self, argument):
+        if not self.sink.starttls_options or self.is_tls:
+            self.reply(454, "TLS not available")
+            return
+        yield self.reply_now(220, "Ready to start TLS")
+        self.stream = yield self.stream.start_tls(True, self.sink.starttls_options)
+        self.is_tls = True
+        self.username = None
+        self.reset()
+
+    @tornado.gen.coroutine
+    def do_auth(self, argument):
+        mechanism, _, initial_response = argument.partition(" ")
+        mechanism = mechanism.upper()
+        if mechanism == "PLAIN":
+            response = base64.b64decode(initial_response) if initial_response else (yield self.challenge(""))
+            _, username, password = response.split(b"\0")
+            is_valid = self.check_password(username, password)
+        elif mechanism == "LOGIN":
+            username = base64.b64decode(initial_response) if initial_response else (yield self.challenge("VXNlcm5hbWU6"))
+            password = yield self.challenge("UGFzc3dvcmQ6")
+            is_valid = self.check_password(username, password)
+        elif mechanism == "CRAM-MD5":
+            challenge = "<{}.{}@sink>".format(random.getrandbits(32), time.time()).encode("ascii")
+            response = yield self.challenge(base64.b64encode(challenge).decode("ascii"))
+            username, _, digest = response.rpartition(b" ")
+            password = self.sink.users.get(username.decode("utf-8"))
+            is_valid = password is not None and hmac.compare_digest(
+                hmac.new(password.encode("utf-8"), challenge, "md5").hexdigest().encode("ascii"), digest)
+        else:
+            self.reply(504, "Unrecognized authentication type")
+            return
+        if is_valid:
+            self.username = username
+            self.reply(235, "Authentication successful")
+        else:
+            self.reply(535, "Authentication credentials invalid")
+
+    def check_password(self, username, password):
+        "Checks PLAIN and LOGIN credentials."
+        return self.sink.users.get(username.decode("utf-8")) == password.decode("utf-8")
+
+    @tornado.gen.coroutine
+    def do_mail(self, argument):
+        if self.sink.users and self.username is None:
+            self.reply(530, "Authentication required")
+        elif self.sender is not None:
+            self.reply(503, "Nested MAIL command")
+        else:
+            match = re.match(r"FROM:\s*<([^>]*)>", argument, re.IGNORECASE)
+            if match is None:
+                self.reply(501, "Syntax error")
+                return
+            self.sender = match.group(1)
+            self.reply(250, "OK")
+
+    @tornado.gen.coroutine
+    def do_rcpt(self, argument):
+        if self.sender is None:
+            self.reply(503, "Need MAIL command")
+            return
+        match = re.match(r"TO:\s*<([^>]+)>", argument, re.IGNORECASE)
+        if match is None:
+            self.reply(501, "Syntax error")
+            return
+        self.recipients.append(match.group(1))
+        self.reply(250, "OK")
+
+    @tornado.gen.coroutine
+    def do_data(self, argument):
+        if not self.recipients:
+            self.reply(554, "No valid recipients")
+            return
+        self.reply(354, "End data with <CR><LF>.<CR><LF>")
+        data = yield self.stream.read_until(CRLF + b"." + CRLF)
+        # Strip the terminating dot and undo dot-stuffing.
+        data = re.sub(br"(\A|\n)\.", br"\1", data[:-3])
+        if random.random() < self.sink.failure_rate:
+            self.reply(451, "Requested action aborted: local error in processing")
+        else:
+            self.sink.messages.append(Message(self.sender, self.recipients, data))
+            self.reply(250, "OK: queued")
+        self.reset()
+
+    @tornado.gen.coroutine
+    def do_rset(self, argument):
+        self.reset()
+        self.reply(250, "OK")
+
+    @tornado.gen.coroutine
+    def do_noop(self, argument):
+        self.reply(250, "OK")
+
+    @tornado.gen.coroutine
+    def do_quit(self, argument):
+        yield self.reply_now(221, "Bye")
+        self.stream.close()
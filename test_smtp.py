@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+"SMTP Client Unit Tests."
+
+import smtplib
+import socket
+import ssl
+import tempfile
+
+import pytest
+import tornado.gen
+import tornado.ioloop
+import tornado.iostream
+
+import smtp
+import smtp_sink
+
+
+USERS = {"user": "password"}
+
+
+def run(coroutine):
+    "Runs coroutine on the current I/O loop."
+    return tornado.ioloop.IOLoop.current().run_sync(coroutine)
+
+
+@tornado.gen.coroutine
+def connect(sink):
+    "Connects a client to the sink."
+    client = smtp.SMTPAsync(local_hostname="localhost")
+    yield client.connect("127.0.0.1", sink.listen_local())
+    return client
+
+
+# Data encoding tests.
+# ------------------------------------------------------------------------------
+
+@pytest.mark.parametrize("msg, data", [
+    (b"", b"\r\n.\r\n"),
+    (b"Hello\r\n", b"Hello\r\n.\r\n"),
+    (b".Hello\r\n.\r\nWorld", b"..Hello\r\n..\r\nWorld\r\n.\r\n"),
+])
+@pytest.mark.parametrize("chunk_size", [1, 3, 1024])
+def test_iter_data_chunks(msg, data, chunk_size):
+    "Tests iter_data_chunks."
+    chunks = list(smtp.iter_data_chunks(msg, chunk_size))
+    assert b"".join(chunks) == data
+    assert all(len(chunk) <= chunk_size for chunk in chunks)
+
+
+# Client tests.
+# ------------------------------------------------------------------------------
+
+def test_getreply():
+    "Tests that getreply splits pipelined replies which arrive in one chunk."
+    client_socket, server_socket = socket.socketpair()
+    client = smtp.SMTPAsync(local_hostname="localhost")
+    client.stream = tornado.iostream.IOStream(client_socket)
+    server_socket.sendall(b"250-first\r\n250 second\r\n354 go on\r\n")
+
+    @tornado.gen.coroutine
+    def test():
+        return [(yield client.getreply()), (yield client.getreply())]
+
+    try:
+        assert run(test) == [(250, b"first\nsecond"), (354, b"go on")]
+    finally:
+        client.stream.close()
+        server_socket.close()
+
+
+@pytest.mark.parametrize("pipelining", [True, False])
+def test_sendmail(pipelining):
+    "Tests sendmail with and without pipelining."
+    sink = smtp_sink.SMTPSink(pipelining=pipelining)
+
+    @tornado.gen.coroutine
+    def test():
+        client = yield connect(sink)
+        senderrs = yield client.sendmail("from@example.org", ["a@example.org", "b@example.org"], b".dot\r\nline\r\n")
+        yield client.quit()
+        return senderrs
+
+    assert run(test) == {}
+    assert sink.messages == [smtp_sink.Message("from@example.org", ["a@example.org", "b@example.org"], b".dot\r\nline\r\n")]
+    sink.stop()
+
+
+@pytest.mark.parametrize("pipelining", [True, False])
+def test_sendmail_refused(pipelining):
+    "Tests that refused senders keep the session usable."
+    sink = smtp_sink.SMTPSink(users=USERS, pipelining=pipelining)
+
+    @tornado.gen.coroutine
+    def test():
+        client = yield connect(sink)
+        with pytest.raises(smtplib.SMTPSenderRefused):
+            yield client.sendmail("from@example.org", ["a@example.org"], b"Hello\r\n")
+        code, _ = yield client.rset()
+        return code
+
+    assert run(test) == 250
+    assert sink.messages == []
+    sink.stop()
+
+
+@pytest.mark.parametrize("mechanism", ["CRAM-MD5", "PLAIN", "LOGIN"])
+def test_login(mechanism):
+    "Tests authentication mechanisms."
+    sink = smtp_sink.SMTPSink(users=USERS)
+
+    @tornado.gen.coroutine
+    def test():
+        client = yield connect(sink)
+        yield client.ehlo_or_helo_if_needed()
+        client.esmtp_features["auth"] = mechanism  # only offer the tested mechanism
+        code, _ = yield client.login("user", "password")
+        yield client.sendmail("from@example.org", ["a@example.org"], b"Hello\r\n")
+        return code
+
+    assert run(test) == 235
+    assert len(sink.messages) == 1
+    sink.stop()
+
+
+def test_starttls():
+    "Tests STARTTLS with a self-signed certificate."
+    with tempfile.TemporaryDirectory() as directory:
+        sink = smtp_sink.SMTPSink(starttls_options=smtp_sink.make_self_signed_certificate(directory))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+
+        @tornado.gen.coroutine
+        def test():
+            client = yield connect(sink)
+            code, _ = yield client.starttls(context)
+            yield client.sendmail("from@example.org", ["a@example.org"], b"Hello\r\n")
+            return code
+
+        assert run(test) == 220
+    assert len(sink.messages) == 1
+    sink.stop()
+
+
+def test_pool():
+    "Tests that the pool reuses connections."
+    sink = smtp_sink.SMTPSink(users=USERS, latency=0.001)
+    pool = smtp.SMTPPool("127.0.0.1", sink.listen_local(), username="user", password="password", max_size=2)
+
+    @tornado.gen.coroutine
+    def test():
+        yield [pool.sendmail("from@example.org", ["a@example.org"], b"Hello\r\n") for _ in range(10)]
+
+    run(test)
+    assert len(sink.messages) == 10
+    assert pool._size == 2
+    pool.close()
+    sink.stop()
@@ -3,8 +3,15 @@
 
 "Wot Ideas Unit Tests."
 
+import collections
+import datetime
+import fractions
+import pickle
+import random
+
 import bson
 import motor
+import numpy
 import pytest
 import requests
 import tornado.gen
@@ -22,6 +29,39 @@ def test_encode_object_id():
     assert wotideas.decode_object_id(wotideas.encode_object_id(object_id)) == object_id
 
 
+def test_encode_cursor():
+    "Tests encode_cursor and decode_cursor."
+    document = {"_id": bson.objectid.ObjectId(), "close_date": datetime.datetime(2014, 9, 1, 12, 30)}
+    cursor = wotideas.encode_cursor(document, "close_date")
+    assert wotideas.decode_cursor(cursor, "close_date") == (document["close_date"], document["_id"])
+    with pytest.raises(ValueError):
+        wotideas.decode_cursor(cursor, "freeze_date")
+    with pytest.raises(ValueError):
+        wotideas.decode_cursor("garbage", "close_date")
+    injected_cursor = wotideas.encode_cursor({"_id": document["_id"], "close_date": {"$ne": None}}, "close_date")
+    with pytest.raises(ValueError):
+        wotideas.decode_cursor(injected_cursor, "close_date")
+
+
+def test_encode_session():
+    "Tests encode_session and decode_session."
+    user = wotideas.User(5589968, "Танкист")
+    assert wotideas.decode_session(wotideas.encode_session(user)) == user
+    for account_id in (-1, 2 ** 64):
+        with pytest.raises(ValueError):
+            wotideas.encode_session(wotideas.User(account_id, "Танкист"))
+    with pytest.raises(ValueError):
+        wotideas.decode_session(b"\x00")
+
+
+def test_decode_legacy_session():
+    "Tests decode_legacy_session."
+    user = wotideas.User(1, "py.test")
+    assert wotideas.decode_legacy_session(pickle.dumps(user)) == user
+    with pytest.raises(ValueError):
+        wotideas.decode_legacy_session(pickle.dumps(collections.OrderedDict()))
+
+
 # Prize tests.
 # ------------------------------------------------------------------------------
 
@@ -34,12 +74,409 @@ def bet(account_id, bet, coins):
     ([], True, []),
     ([bet(1, True, 100), bet(2, False, 50)], True, [wotideas.Prize(1, 150.0)]),
     ([bet(1, True, 100), bet(2, True, 50)], False, []),
+    ([bet(2, True, 10), bet(1, True, 10), bet(2, True, 10), bet(3, False, 1)], True, [wotideas.Prize(1, 10.33), wotideas.Prize(2, 20.67)]),
+    ([bet(1, True, 0.001), bet(2, False, 50)], True, []),
 ])
 def test_get_prizes(bets, resolution, prizes):
     "Tests get_prizes."
     assert wotideas.get_prizes(bets, resolution) == prizes
 
 
+def test_make_pool():
+    "Tests make_pool."
+    pool = wotideas.make_pool([bet(1, True, 100), bet(2, False, 50), bet(3, True, 10)])
+    assert pool == {"coins": 160.0, "count": 3, "yes": {"coins": 110.0, "count": 2}, "no": {"coins": 50.0, "count": 1}}
+    assert wotideas.get_prizes([bet(1, True, 100), bet(3, True, 10)], True, pool) == [wotideas.Prize(1, 145.45), wotideas.Prize(3, 14.55)]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_compute_prizes(seed):
+    "Tests that prizes add up to the budget and stay within a cent of the exact share."
+    state = random.Random(seed)
+    bet_count = state.randint(1, 1000)
+    account_ids = numpy.array([state.randint(1, bet_count) for _ in range(bet_count)], numpy.int64)
+    stakes = numpy.array([state.randint(1, 10 ** state.randint(1, 12)) for _ in range(bet_count)], numpy.int64)
+    budget = int(stakes.sum()) + state.randint(0, 10 ** state.randint(1, 12))
+    prize_account_ids, prizes = wotideas.compute_prizes(account_ids, stakes, budget)
+    assert int(prizes.sum()) == budget
+    assert prize_account_ids.tolist() == sorted(set(account_ids.tolist()))
+    total_stakes = collections.Counter()
+    for account_id, stake in zip(account_ids.tolist(), stakes.tolist()):
+        total_stakes[account_id] += stake
+    for account_id, prize in zip(prize_account_ids.tolist(), prizes.tolist()):
+        assert abs(prize - fractions.Fraction(budget * total_stakes[account_id], int(stakes.sum()))) < 1
+
+
+# Cache tests.
+# ------------------------------------------------------------------------------
+
+def test_balance_cache():
+    "Tests BalanceCache eviction and counters."
+    cache = wotideas.BalanceCache(ttl=60.0, max_size=2)
+    assert cache.get(1) is None
+    cache.set(1, 100.0)
+    cache.set(2, 200.0)
+    assert cache.get(1) == 100.0
+    cache.set(3, 300.0)  # evicts 2 as least recently used
+    assert cache.get(2) is None
+    cache.invalidate(1)
+    assert cache.get(1) is None
+    assert cache.get_statistics() == {"size": 1, "hits": 1, "misses": 3}
+
+
+def test_balance_cache_ttl():
+    "Tests BalanceCache expiration."
+    cache = wotideas.BalanceCache(ttl=-1.0)
+    cache.set(1, 100.0)
+    assert cache.get(1) is None
+
+
+def test_leaderboard():
+    "Tests Leaderboard incremental updates."
+    leaderboard = wotideas.Leaderboard(size=2, capacity=3)
+    leaderboard.floor = float("-inf")  # as if all accounts were loaded
+    for account_id, coins in [(1, 100.0), (2, 50.0), (3, 75.0), (4, 10.0)]:
+        leaderboard.update(account_id, "player{}".format(account_id), coins)
+    assert [account["_id"] for account in leaderboard.get_top()] == [1, 3]
+    assert leaderboard.floor == 10.0  # account 4 got evicted
+    leaderboard.update(1, "player1", 5.0)  # drops below the floor
+    assert [account["_id"] for account in leaderboard.get_top()] == [3, 2]
+    assert leaderboard.get_rank(2) == 2
+    assert leaderboard.get_rank(1) is None
+
+
+def test_page_cache():
+    "Tests PageCache eviction by size and invalidation by tag."
+    cache = wotideas.PageCache(ttl=60.0, max_size=10)
+    page = wotideas.Page(b"12345", None)
+    cache.set("/", page, ["ideas"])
+    cache.set("/i/1", wotideas.Page(b"1234", '"1"'), ["idea:1", "accounts"])
+    assert cache.get("/") == page
+    cache.set("/accounts", wotideas.Page(b"123", None), ["accounts"])  # evicts /i/1 as least recently used
+    assert cache.get("/i/1") is None
+    cache.invalidate("idea:2", "accounts")
+    assert cache.get("/accounts") is None
+    assert cache.get("/") == page
+    assert cache.get_statistics() == {"size": 1, "bytes": 5, "hits": 2, "misses": 2}
+    assert cache.keys == {"ideas": {"/"}}
+
+
+class InvalidationCollection:
+    "Captures broadcast invalidations."
+
+    def __init__(self):
+        self.messages = []
+
+    @tornado.gen.coroutine
+    def insert(self, message):
+        self.messages.append(message)
+
+
+class InvalidationDatabase:
+    "Database with the invalidations collection only."
+
+    def __init__(self):
+        self.invalidations = InvalidationCollection()
+
+
+def make_cache_invalidator(db, broadcast):
+    "Makes cache invalidator with empty caches. The leaderboard tracks all accounts."
+    cache_invalidator = wotideas.CacheInvalidator(db, wotideas.BalanceCache(), wotideas.Leaderboard(), wotideas.PageCache(), wotideas.IdeaCounters(), broadcast)
+    cache_invalidator.leaderboard.floor = float("-inf")
+    return cache_invalidator
+
+
+def test_cache_invalidator():
+    "Tests that CacheInvalidator applies invalidations of another process."
+    db = InvalidationDatabase()
+    sender, receiver = make_cache_invalidator(db, True), make_cache_invalidator(db, True)
+    receiver.balance_cache.set(1, 100.0)
+    receiver.page_cache.set("/accounts", wotideas.Page(b"accounts", None), ["accounts"])
+    accounts = [{"_id": account_id, "nickname": "player", "coins": 90.0} for account_id in range(1, 1502)]
+    tornado.ioloop.IOLoop.current().run_sync(lambda: sender.invalidate(accounts=accounts, tags=["accounts"]))
+    assert [len(message["accounts"]) for message in db.invalidations.messages] == [1000, 501]
+    assert [message["tags"] for message in db.invalidations.messages] == [[], ["accounts"]]
+    for message in db.invalidations.messages:
+        tornado.ioloop.IOLoop.current().run_sync(lambda: receiver.apply(message))
+    assert receiver.balance_cache.get(1) is None
+    assert receiver.page_cache.get("/accounts") is None
+    assert len(receiver.leaderboard.get_top()) == wotideas.Leaderboard.SIZE
+
+
+# Event writer tests.
+# ------------------------------------------------------------------------------
+
+class EventCollection:
+    "In-memory stand-in for the events collection."
+
+    def __init__(self):
+        self.events = []
+
+    def initialize_unordered_bulk_op(self):
+        return EventBulkOperation(self)
+
+
+class EventBulkOperation:
+
+    def __init__(self, collection):
+        self.collection = collection
+        self.events = []
+
+    def insert(self, event):
+        self.events.append(event)
+
+    @tornado.gen.coroutine
+    def execute(self):
+        yield tornado.gen.moment
+        self.collection.events.extend(self.events)
+
+
+def test_event_writer():
+    "Tests EventWriter batching and ordering."
+    db = collections.namedtuple("Database", ["events"])(EventCollection())
+    event_writer = wotideas.EventWriter(db, max_size=3, flush_delay=60.0)
+
+    @tornado.gen.coroutine
+    def write():
+        for account_id in range(5):
+            yield event_writer.write(wotideas.make_event(wotideas.SystemEventType.LOGGED_IN, account_id=account_id))
+        yield tornado.gen.moment
+        assert len(db.events.events) == 3  # flushed on the size threshold
+        yield event_writer.flush()
+
+    tornado.ioloop.IOLoop.current().run_sync(write)
+    assert [event["kwargs"]["account_id"] for event in db.events.events] == list(range(5))
+    assert sorted(event["_id"] for event in db.events.events) == [event["_id"] for event in db.events.events]
+
+
+# Idea scheduler tests.
+# ------------------------------------------------------------------------------
+
+def idea(freeze_days, close_days, resolved=False):
+    "Shortcut."
+    now = datetime.datetime.utcnow()
+    return {
+        "_id": bson.objectid.ObjectId(),
+        "freeze_date": now + datetime.timedelta(days=freeze_days),
+        "close_date": now + datetime.timedelta(days=close_days),
+        "resolved": resolved,
+    }
+
+
+@pytest.mark.parametrize("idea, status", [
+    (idea(1, 2), wotideas.IdeaStatus.OPEN),
+    (idea(-1, 2), wotideas.IdeaStatus.FROZEN),
+    (idea(-2, -1), wotideas.IdeaStatus.CLOSED),
+    (idea(-2, -1, True), wotideas.IdeaStatus.RESOLVED),
+])
+def test_get_idea_status(idea, status):
+    "Tests get_idea_status."
+    assert wotideas.get_idea_status(idea, datetime.datetime.utcnow()) == status
+
+
+def test_idea_scheduler():
+    "Tests IdeaScheduler timer heap."
+    scheduler = wotideas.IdeaScheduler(None, None)
+    ideas = [
+        dict(idea(2, 3), status=wotideas.IdeaStatus.OPEN.value),
+        dict(idea(-1, 1), status=wotideas.IdeaStatus.FROZEN.value),
+        dict(idea(-2, -1), status=wotideas.IdeaStatus.CLOSED.value),
+    ]
+    for document in ideas:
+        scheduler.schedule(document)
+    assert [idea_id for _, idea_id in sorted(scheduler.heap)] == [ideas[1]["_id"], ideas[0]["_id"]]
+    assert scheduler.timeout_date == ideas[1]["close_date"]
+    tornado.ioloop.IOLoop.current().remove_timeout(scheduler.timeout)
+
+
+# Idea counter tests.
+# ------------------------------------------------------------------------------
+
+class IdeaCollection:
+    "In-memory stand-in for the ideas collection counting queries."
+
+    def __init__(self):
+        self.query_count = 0
+
+    def find(self, spec):
+        self.query_count += 1
+        return self
+
+    @tornado.gen.coroutine
+    def count(self):
+        yield tornado.gen.moment
+        return self.query_count
+
+
+def test_idea_counters():
+    "Tests IdeaCounters refresh coalescing."
+    db = collections.namedtuple("Database", ["ideas"])(IdeaCollection())
+    idea_counters = wotideas.IdeaCounters()
+
+    @tornado.gen.coroutine
+    def refresh():
+        yield [idea_counters.refresh(db) for _ in range(3)]
+        while idea_counters.is_refreshing:
+            yield tornado.gen.moment
+
+    tornado.ioloop.IOLoop.current().run_sync(refresh)
+    statuses = wotideas.IdeaCounters.STATUSES
+    assert db.ideas.query_count == 2 * len(statuses)  # the concurrent refreshes ran once more
+    assert sorted(idea_counters.counts, key=statuses.index) == statuses
+
+
+# Event archive tests.
+# ------------------------------------------------------------------------------
+
+@pytest.mark.parametrize("month, count, expected", [
+    (datetime.datetime(2014, 9, 1), -6, datetime.datetime(2014, 3, 1)),
+    (datetime.datetime(2014, 9, 1), -9, datetime.datetime(2013, 12, 1)),
+    (datetime.datetime(2014, 12, 1), 1, datetime.datetime(2015, 1, 1)),
+])
+def test_add_months(month, count, expected):
+    "Tests add_months."
+    assert wotideas.add_months(month, count) == expected
+
+
+def test_event_archive(tmpdir):
+    "Tests EventArchive partitions and ledger reader."
+    archive = wotideas.EventArchive(str(tmpdir))
+    month = datetime.datetime(2014, 9, 1)
+    events = [
+        dict(wotideas.make_event(wotideas.SystemEventType.MADE_BET, account_id=account_id, coins=10.0), _id=bson.objectid.ObjectId())
+        for account_id in (1, 2, 1)
+    ]
+    with archive.open_partition("ledger", month) as partition:
+        for event in events[:2]:
+            partition.write(event)
+    with archive.open_partition("ledger", month) as partition:
+        for event in events[1:]:  # merges with the existing partition
+            partition.write(event)
+    with archive.open_partition("events", month) as partition:
+        pass  # empty partitions are not created
+    assert archive.get_months("ledger") == [month]
+    assert archive.get_months("events") == []
+    assert list(archive.find_ledger_events(1)) == [events[2], events[0]]
+    assert list(archive.find_ledger_events(1, before=events[2]["_id"])) == [events[0]]
+    assert list(archive.find_ledger_events(2)) == [events[1]]
+    assert list(archive.find_ledger_events(3)) == []
+    assert len(list(archive.iter_ledger_events())) == 3
+    # Partitions archived before the index are scanned.
+    archive.get_index_path(month).unlink()
+    assert list(archive.find_ledger_events(1)) == [events[2], events[0]]
+    assert list(archive.find_ledger_events(3)) == []
+    tornado.ioloop.IOLoop.current().run_sync(lambda: wotideas.index_archive(archive))
+    assert archive.get_index_path(month).exists()
+    assert list(archive.find_ledger_events(1)) == [events[2], events[0]]
+
+
+# Tests that require a running MongoDB.
+# ------------------------------------------------------------------------------
+
+def get_handler_queries():
+    "Gets collection, spec and sort of handler queries."
+    now = datetime.datetime.utcnow()
+    queries = []
+    for status in (None, "all", "closed", "unresolved"):
+        sort_by = wotideas.get_index_query(status)[1]
+        after = wotideas.encode_cursor({"_id": bson.objectid.ObjectId(), sort_by: now}, sort_by)
+        for spec, sort_by, direction in [
+            wotideas.get_index_query(status, [bson.objectid.ObjectId()]),
+            wotideas.get_index_query(status, [bson.objectid.ObjectId()], after),
+        ]:
+            queries.append(("ideas", spec, [(sort_by, direction), ("_id", direction)]))
+    return queries + [
+        ("ideas", {"status": {"$in": [wotideas.IdeaStatus.OPEN.value, wotideas.IdeaStatus.FROZEN.value]}}, None),
+        ("bets", {"idea_id": bson.objectid.ObjectId()}, [("_id", -1)]),
+        ("bets", {"idea_id": bson.objectid.ObjectId(), "bet": True}, None),
+        ("bets", {"account_id": 1}, None),
+        ("bets", {"pending": True, "lease": {"$not": {"$gt": now}}}, None),
+        ("events", wotideas.get_ledger_query(1), [("_id", -1)]),
+        ("events", wotideas.get_ledger_query(1, bson.objectid.ObjectId()), [("_id", -1)]),
+        ("accounts", {}, [("coins", -1)]),
+        ("accounts", {"coins": {"$gt": 100.0}}, None),
+        ("accounts", {"payouts.i": bson.objectid.ObjectId()}, None),
+        ("mail", {"status": "pending", "next_attempt": {"$lte": now}}, [("next_attempt", 1)]),
+        ("resolutions", {"state": {"$in": ["pending", "paying"]}, "lease": {"$lt": now}}, None),
+        ("prizes", {"idea_id": bson.objectid.ObjectId(), "paid": False}, [("_id", 1)]),
+    ]
+
+
+@pytest.mark.parametrize("collection_name, spec, sort", get_handler_queries())
+def test_indexes(collection_name, spec, sort):
+    "Tests that the handler query does not scan the collection."
+    @tornado.gen.coroutine
+    def explain():
+        db = motor.MotorClient()["wotideas_test"]
+        yield wotideas.sync_indexes(db)
+        yield db[collection_name].insert({})  # the collection must exist
+        cursor = db[collection_name].find(spec)
+        if sort is not None:
+            cursor = cursor.sort(sort)
+        return (yield cursor.explain())
+
+    explanation = tornado.ioloop.IOLoop.current().run_sync(explain)
+    plan = repr(explanation["queryPlanner"]["winningPlan"] if "queryPlanner" in explanation else explanation)
+    assert "COLLSCAN" not in plan and "BasicCursor" not in plan, plan
+
+
+def test_apply_bet():
+    "Tests that a repaired bet debits the account and updates the pool once, and that its crashed owner cannot apply it again."
+    @tornado.gen.coroutine
+    def apply_twice():
+        db = motor.MotorClient()["wotideas_test"]
+        yield db.accounts.remove({"_id": 1})
+        yield db.accounts.insert({"_id": 1, "nickname": "one", "coins": 10.0})
+        idea_id = yield db.ideas.insert({"pool": wotideas.make_pool()})
+        bet = {
+            "_id": bson.objectid.ObjectId(), "idea_id": idea_id, "account_id": 1, "nickname": "one", "coins": 4.0, "bet": True,
+            "pending": True, "owner": bson.objectid.ObjectId(), "lease": datetime.datetime.utcnow(),
+        }
+        yield db.bets.insert(bet)
+        # The owner has debited the account and crashed.
+        yield db.accounts.update({"_id": 1}, {"$inc": {"coins": -4.0}, "$push": {"pending_bets": bet["_id"]}})
+        assert len((yield wotideas.repair_bets(db))) == 1
+        with pytest.raises(wotideas.LeaseLostError):
+            yield wotideas.apply_bet(db, bet)
+        account = yield db.accounts.find_one({"_id": 1})
+        idea = yield db.ideas.find_one({"_id": idea_id})
+        bet = yield db.bets.find_one({"_id": bet["_id"]})
+        event_count = yield db.events.find({"_id": bet["_id"]}).count()
+        return account, idea, bet, event_count
+
+    account, idea, bet, event_count = tornado.ioloop.IOLoop.current().run_sync(apply_twice)
+    assert (account["coins"], account["pending_bets"]) == (6.0, [])
+    assert (idea["pool"]["yes"], idea["pending_bets"]) == ({"coins": 4.0, "count": 1}, [])
+    assert "pending" not in bet
+    assert event_count == 1
+
+
+def test_pay_prizes():
+    "Tests that paying the same prizes twice credits accounts once."
+    @tornado.gen.coroutine
+    def pay_twice():
+        db = motor.MotorClient()["wotideas_test"]
+        yield db.accounts.remove({"_id": {"$in": [1, 2]}})
+        yield db.accounts.insert([{"_id": 1, "nickname": "one", "coins": 10.0}, {"_id": 2, "nickname": "two", "coins": 10.0}])
+        idea_id = bson.objectid.ObjectId()
+        prizes = [
+            {"_id": {"i": idea_id, "a": account_id}, "event_id": bson.objectid.ObjectId(), "idea_id": idea_id, "account_id": account_id, "coins": coins, "paid": False}
+            for account_id, coins in ((1, 12.0), (2, 3.0))
+        ]
+        yield db.prizes.insert(prizes)
+        for _ in range(2):
+            yield wotideas.pay_prizes(db, idea_id, prizes)
+        accounts = yield db.accounts.find({"_id": {"$in": [1, 2]}}).sort("_id").to_list(2)
+        event_count = yield db.events.find({"kwargs.idea_id": idea_id}).count()
+        paid_count = yield db.prizes.find({"idea_id": idea_id, "paid": True}).count()
+        return accounts, event_count, paid_count
+
+    accounts, event_count, paid_count = tornado.ioloop.IOLoop.current().run_sync(pay_twice)
+    assert [(account["coins"], len(account["payouts"])) for account in accounts] == [(22.0, 1), (13.0, 1)]
+    assert event_count == 2
+    assert paid_count == 2
+
+
 # Web handler tests.
 # ------------------------------------------------------------------------------
 
@@ -66,6 +503,13 @@ def test_anonymous_home(anonymous_session, url):
     anonymous_session.get(url).raise_for_status()
 
 
+def test_not_modified(anonymous_session, url):
+    response = anonymous_session.get("{}/all".format(url))
+    response.raise_for_status()
+    response = anonymous_session.get("{}/all".format(url), headers={"If-None-Match": response.headers["Etag"]})
+    assert response.status_code == 304
+
+
 def test_loggedin_home(loggedin_session, url):
     loggedin_session.get(url).raise_for_status()
 
@@ -76,3 +520,9 @@ def test_profile(loggedin_session, url):
 
 def test_balance(loggedin_session, url):
     loggedin_session.get("{}/balance".format(url)).raise_for_status()
+
+
+def test_balance_export(loggedin_session, url):
+    response = loggedin_session.get("{}/balance.csv".format(url))
+    response.raise_for_status()
+    assert response.text.startswith("date,type,coins,balance,idea")
@@ -8,21 +8,39 @@ import sys; sys.dont_write_bytecode = True
 import argparse
 import base64
 import collections
+import csv
 import datetime
+import email.mime.text
+import email.utils
 import enum
+import gzip
+import hashlib
+import heapq
 import http.client
+import io
+import itertools
 import logging
 import operator
 import os
 import pathlib
 import pickle
+import signal
+import struct
+import time
 
 import bson
+import bson.json_util
 import motor
+import numpy
 import pymongo
 import smtp
+import tornado.concurrent
+import tornado.escape
 import tornado.gen
+import tornado.httpserver
 import tornado.ioloop
+import tornado.netutil
+import tornado.process
 import tornado.web
 
 import config
@@ -38,18 +56,101 @@ def main(args):
     "Entry point."
     logging.info("Checking environment…")
     check_environment()
+    command = get_maintenance_command(args)
+    if command is not None:
+        logging.info("Initializing database…")
+        db = initialize_database(args.database)
+        return tornado.ioloop.IOLoop.current().run_sync(lambda: command(db))
+    logging.info("Checking database…")
+    check_database(args.database)
+    serve(args)
+
+
+def get_maintenance_command(args):
+    "Gets the maintenance command to run instead of serving requests."
+    if args.migrate_bets:
+        logging.info("Migrating bets…")
+        return migrate_bets
+    if args.rebuild_statistics:
+        logging.info("Rebuilding account statistics…")
+        return rebuild_statistics
+    if args.backfill_pools:
+        logging.info("Backfilling idea pools…")
+        return backfill_pools
+    if args.archive_events:
+        logging.info("Archiving events…")
+        return lambda db: archive_events(db, EventArchive())
+    if args.sync_indexes:
+        logging.info("Synchronizing indexes…")
+        return sync_indexes
+    if args.backfill_status:
+        logging.info("Backfilling idea status…")
+        return backfill_status
+    if args.index_archive:
+        logging.info("Indexing event archive…")
+        return lambda db: index_archive(EventArchive())
+    return None
+
+
+def serve(args):
+    "Serves requests. The I/O loop and the database client must not exist before worker processes are forked."
+    logging.info("Binding to port %d…", args.port)
+    sockets = tornado.netutil.bind_sockets(args.port)
+    if args.processes != 1:
+        logging.info("Forking worker processes…")
+        task_id = fork_workers(args.processes)
+        logging.info("Worker #%d has been started.", task_id)
     logging.info("Initializing database…")
-    db = initialize_database("wotideas")
+    db = initialize_database(args.database)
     logging.info("Initializing application…")
-    initialize_web_application(db).listen(HTTP_PORT)
+    event_writer = EventWriter(db) if args.buffer_events else None
+    application = initialize_web_application(db, event_writer, args.processes != 1)
+    server = tornado.httpserver.HTTPServer(application)
+    server.add_sockets(sockets)
+    install_signal_handlers(server, event_writer)
+    application.settings["cache_invalidator"].start()
+    application.settings["idea_counters"].start(db)
+    application.settings["idea_scheduler"].start()
+    application.settings["resolver"].start()
+    logging.info("Starting mail queue…")
+    MailQueue(db, initialize_smtp_pool()).start()
     logging.info("I/O loop is being started.")
     tornado.ioloop.IOLoop.current().start()
 
 
+def fork_workers(count):
+    "Forks worker processes and returns the worker task ID. Crashed workers are restarted."
+    def terminate_workers(signum, frame):
+        # The workers shut down gracefully, then fork_processes exits.
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(signum, signal.SIG_IGN)
+        os.killpg(0, signal.SIGTERM)
+    # Lead a process group of our own so that the signal does not reach whoever started us.
+    if os.getpgrp() != os.getpid():
+        os.setpgrp()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, terminate_workers)
+    task_id = tornado.process.fork_processes(count)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_DFL)
+    return task_id
+
+
 def get_argument_parser():
     "Initializes argument parser."
     parser = argparse.ArgumentParser(description=globals()["__doc__"])
     parser.add_argument("--log-file", default=sys.stderr, help="log file", metavar="<file>", type=argparse.FileType("wt"))
+    parser.add_argument("--port", default=HTTP_PORT, help="HTTP port", metavar="<port>", type=int)
+    parser.add_argument("--processes", default=1, help="number of worker processes, 0 for one per CPU", metavar="<n>", type=int)
+    parser.add_argument("--database", default="wotideas", help="database name", metavar="<name>")
+    parser.add_argument("--buffer-events", action="store_true", help="write system events in batches")
+    parser.add_argument("--migrate-bets", action="store_true", help="move embedded idea bets into the bets collection and exit")
+    parser.add_argument("--backfill-pools", action="store_true", help="recompute idea pools from bets and exit")
+    parser.add_argument("--rebuild-statistics", action="store_true", help="recompute account statistics from events and exit")
+    parser.add_argument("--archive-events", action="store_true", help="move events past the retention period to the archive and exit")
+    parser.add_argument("--sync-indexes", action="store_true", help="build declared indexes, drop undeclared ones and exit")
+    parser.add_argument("--backfill-status", action="store_true", help="compute stored idea status from dates and exit")
+    parser.add_argument("--index-archive", action="store_true", help="index archived ledger partitions by account and exit")
     return parser
 
 
@@ -57,6 +158,33 @@ def configure_logging(args):
     logging.basicConfig(format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO, stream=args.log_file)
 
 
+SHUTDOWN_DELAY = 1.0  # seconds given to requests in progress
+
+
+def install_signal_handlers(server, event_writer):
+    "Shuts down gracefully on SIGINT and SIGTERM."
+    def handle_signal(signum, frame):
+        tornado.ioloop.IOLoop.current().add_callback_from_signal(shutdown, server, event_writer)
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, handle_signal)
+
+
+@tornado.gen.coroutine
+def shutdown(server, event_writer):
+    "Stops accepting connections, flushes buffered events and stops the I/O loop."
+    logging.info("Shutting down…")
+    server.stop()
+    delay = tornado.concurrent.Future()
+    tornado.ioloop.IOLoop.current().call_later(SHUTDOWN_DELAY, delay.set_result, None)
+    yield delay
+    if event_writer is not None:
+        try:
+            yield event_writer.flush()
+        except Exception:
+            logging.exception("Failed to flush events.")
+    tornado.ioloop.IOLoop.current().stop()
+
+
 # Initialization.
 # ------------------------------------------------------------------------------
 
@@ -68,21 +196,77 @@ def check_environment():
         raise ValueError("not found: templates")
 
 
+def check_database(name):
+    "Checks that the data migrations the code relies on have been run. Uses a blocking client since nothing may be shared with forked workers."
+    client = pymongo.MongoClient()
+    try:
+        for spec, command in [
+            # Bets are read from the bets collection.
+            ({"bets": {"$exists": True}}, "--migrate-bets"),
+            # Bets update the stored pool counters.
+            ({"pool": {"$exists": False}}, "--backfill-pools"),
+            # Pages and idea lists read the stored status.
+            ({"status": {"$exists": False}}, "--backfill-status"),
+        ]:
+            if client[name].ideas.find_one(spec, {"_id": True}) is not None:
+                raise ValueError("found ideas matching {}, run {}".format(spec, command))
+    finally:
+        client.close()
+
+
 def initialize_database(name):
-    "Initializes database."
-    db = motor.MotorClient()[name]
-    db.accounts.ensure_index("coins", pymongo.DESCENDING)
-    db.ideas.ensure_index("close_date", pymongo.DESCENDING)
-    db.ideas.ensure_index("freeze_date", pymongo.DESCENDING)
-    db.ideas.ensure_index("resolved", pymongo.ASCENDING)
-    db.ideas.ensure_index("bets", pymongo.ASCENDING)
-    db.events.ensure_index("type", pymongo.ASCENDING)
-    db.events.ensure_index("kwargs.account_id", pymongo.ASCENDING, sparse=True)
-    return db
-
-
-def initialize_web_application(db):
-    "Initializes application handlers."
+    "Initializes database. Indexes are built by --sync-indexes."
+    return motor.MotorClient()[name]
+
+
+# Indexes follow handler queries: equality fields, then sort fields, then range fields.
+INDEXES = [
+    # Leaderboard and account rank.
+    ("accounts", [("coins", pymongo.DESCENDING)]),
+    # Payout markers of a resolved idea.
+    ("accounts", [("payouts.i", pymongo.ASCENDING)]),
+    # /closed, /unresolved.
+    ("ideas", [("status", pymongo.ASCENDING), ("close_date", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+    # / and the idea scheduler.
+    ("ideas", [("status", pymongo.ASCENDING), ("freeze_date", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+    # /all.
+    ("ideas", [("freeze_date", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+    # Idea bet table and resolution.
+    ("bets", [("idea_id", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)]),
+    # Ideas the user has bet on.
+    ("bets", [("account_id", pymongo.ASCENDING), ("idea_id", pymongo.ASCENDING)]),
+    # Bet repair.
+    ("bets", [("pending", pymongo.ASCENDING), ("lease", pymongo.ASCENDING)]),
+    # Balance page and export.
+    ("events", [("kwargs.account_id", pymongo.ASCENDING), ("type", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)]),
+    # Statistics rebuild.
+    ("events", [("type", pymongo.ASCENDING)]),
+    # Mail queue.
+    ("mail", [("status", pymongo.ASCENDING), ("next_attempt", pymongo.ASCENDING)]),
+    # Resolution jobs.
+    ("resolutions", [("state", pymongo.ASCENDING), ("lease", pymongo.ASCENDING)]),
+    ("prizes", [("idea_id", pymongo.ASCENDING), ("paid", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)]),
+]
+
+
+def initialize_smtp_pool():
+    "Initializes outgoing mail connection pool."
+    return smtp.SMTPPool(
+        config.SMTP_HOST,
+        config.SMTP_PORT,
+        username=config.SMTP_USERNAME,
+        password=config.NO_REPLY_PASS,
+        starttls=config.SMTP_STARTTLS,
+    )
+
+
+def initialize_web_application(db, event_writer=None, broadcast=False):
+    "Initializes application handlers. Cache invalidations are broadcast to other worker processes if requested."
+    balance_cache = BalanceCache()
+    leaderboard = Leaderboard()
+    page_cache = PageCache()
+    idea_counters = IdeaCounters()
+    cache_invalidator = CacheInvalidator(db, balance_cache, leaderboard, page_cache, idea_counters, broadcast)
     return tornado.web.Application(
         [
             (r"/(all|closed|unresolved)?", IndexRequestHandler),
@@ -93,17 +277,185 @@ def initialize_web_application(db):
             (r"/i/([a-zA-Z0-9_\-\=]+)/bet", BetRequestHandler),
             (r"/i/([a-zA-Z0-9_\-\=]+)/resolve", ResolveRequestHandler),
             (r"/balance", BalanceRequestHandler),
+            (r"/balance\.csv", BalanceExportRequestHandler),
             (r"/profile", ProfileRequestHandler),
+            (r"/confirm", ConfirmRequestHandler),
             (r"/accounts", AccountsRequestHandler),
+            (r"/stats", StatsRequestHandler),
         ],
+        balance_cache=balance_cache,
+        cache_invalidator=cache_invalidator,
+        leaderboard=leaderboard,
         cookie_secret=config.COOKIE_SECRET,
         db=db,
+        event_archive=EventArchive(),
+        idea_counters=idea_counters,
+        idea_scheduler=IdeaScheduler(db, cache_invalidator),
+        page_cache=page_cache,
+        resolver=Resolver(db, cache_invalidator),
+        event_writer=event_writer,
         static_path="static",
         template_path="templates",
         xsrf_cookies=True,
     )
 
 
+# Maintenance commands.
+# ------------------------------------------------------------------------------
+
+@tornado.gen.coroutine
+def sync_indexes(db):
+    "Builds missing declared indexes in the background and drops undeclared ones."
+    declared_indexes = collections.defaultdict(list)
+    for collection_name, keys in INDEXES:
+        declared_indexes[collection_name].append(tuple(keys))
+    for collection_name, declared_keys in sorted(declared_indexes.items()):
+        collection = db[collection_name]
+        index_information = yield collection.index_information()
+        existing_indexes = {
+            tuple((field, int(direction)) for field, direction in index["key"]): name
+            for name, index in index_information.items()
+            if name != "_id_"
+        }
+        for keys in declared_keys:
+            if existing_indexes.pop(keys, None) is not None:
+                continue
+            logging.info("Building index %s on %s…", keys, collection_name)
+            yield collection.create_index(list(keys), background=True)
+        for name in existing_indexes.values():
+            logging.info("Dropping index %s on %s…", name, collection_name)
+            yield collection.drop_index(name)
+
+@tornado.gen.coroutine
+def migrate_bets(db):
+    "Moves bets embedded into idea documents into the bets collection. Run it before serving requests."
+    cursor = db.ideas.find({"bets": {"$exists": True}}, {"bets": True})
+    count = 0
+    while (yield cursor.fetch_next):
+        idea = cursor.next_object()
+        if idea["bets"]:
+            # Bet IDs are stored first so that bets inserted by an interrupted run are skipped.
+            if any("_id" not in bet for bet in idea["bets"]):
+                for bet in idea["bets"]:
+                    bet.setdefault("_id", bson.objectid.ObjectId())
+                yield db.ideas.update({"_id": idea["_id"]}, {"$set": {"bets": idea["bets"]}})
+            bulk = db.bets.initialize_unordered_bulk_op()
+            for bet in idea["bets"]:
+                bulk.insert(dict(bet, idea_id=idea["_id"]))
+            yield execute_skipping_duplicates(bulk)
+        yield db.ideas.update({"_id": idea["_id"]}, {"$unset": {"bets": True}})
+        count += 1
+    logging.info("Migrated %d ideas.", count)
+
+
+@tornado.gen.coroutine
+def backfill_status(db):
+    "Computes stored status of all ideas from their dates. Run it before serving requests."
+    now = datetime.datetime.utcnow()
+    cursor = db.ideas.find({}, IDEA_SCHEDULE_FIELDS)
+    count = 0
+    while (yield cursor.fetch_next):
+        idea = cursor.next_object()
+        yield db.ideas.update({"_id": idea["_id"]}, {"$set": {"status": get_idea_status(idea, now).value}})
+        count += 1
+    logging.info("Backfilled %d ideas.", count)
+
+
+@tornado.gen.coroutine
+def backfill_pools(db):
+    "Recomputes pool counters of all ideas from the applied bets. Pending bets are added back by the bet repair."
+    result = yield db.bets.aggregate([
+        {"$match": {"pending": {"$exists": False}}},
+        {"$group": {"_id": {"idea_id": "$idea_id", "bet": "$bet"}, "coins": {"$sum": "$coins"}, "count": {"$sum": 1}}},
+    ])
+    pools = collections.defaultdict(make_pool)
+    for doc in result["result"]:
+        add_to_pool(pools[doc["_id"]["idea_id"]], doc["_id"]["bet"], doc["coins"], doc["count"])
+    cursor = db.ideas.find({}, {"_id": True})
+    count = 0
+    while (yield cursor.fetch_next):
+        idea = cursor.next_object()
+        yield db.ideas.update({"_id": idea["_id"]}, {"$set": {"pool": pools[idea["_id"]]}, "$unset": {"pending_bets": True}})
+        count += 1
+    logging.info("Backfilled %d ideas.", count)
+
+
+@tornado.gen.coroutine
+def rebuild_statistics(db):
+    "Recomputes account statistics from the event log."
+    result = yield db.events.aggregate([
+        {"$match": {"type": {"$in": [SystemEventType.MADE_BET.value, SystemEventType.WIN.value]}}},
+        {"$group": {
+            "_id": {"account_id": "$kwargs.account_id", "type": "$type"},
+            "count": {"$sum": 1},
+            "coins": {"$sum": "$kwargs.coins"},
+        }},
+    ])
+    statistics = collections.defaultdict(make_statistics)
+    for doc in result["result"]:
+        add_to_statistics(statistics[doc["_id"]["account_id"]], doc["_id"]["type"], doc["coins"], doc["count"])
+    for event in EventArchive().iter_ledger_events():
+        add_to_statistics(statistics[event["kwargs"]["account_id"]], event["type"], event["kwargs"]["coins"])
+    yield db.accounts.update({}, {"$set": {"stats": make_statistics()}}, multi=True)
+    for account_id, account_statistics in statistics.items():
+        yield db.accounts.update({"_id": account_id}, {"$set": {"stats": account_statistics}})
+    logging.info("Rebuilt statistics of %d accounts.", len(statistics))
+
+
+@tornado.gen.coroutine
+def archive_events(db, archive):
+    "Moves events older than the retention period into monthly archive partitions."
+    oldest = yield db.events.find({}, {"_id": True}).sort("_id", pymongo.ASCENDING).limit(1).to_list(1)
+    if not oldest:
+        logging.info("No events.")
+        return
+    month = get_month(oldest[0]["_id"].generation_time.replace(tzinfo=None))
+    cutoff = add_months(get_month(datetime.datetime.utcnow()), -archive.RETENTION_MONTHS)
+    while month < cutoff:
+        count = yield archive_partition(db, archive, month)
+        logging.info("Archived %d events of %s.", count, "{:%Y-%m}".format(month))
+        month = add_months(month, 1)
+
+
+@tornado.gen.coroutine
+def archive_partition(db, archive, month):
+    "Archives events of the month, then removes them from the database. Returns the number of archived events."
+    start = bson.objectid.ObjectId.from_datetime(month)
+    end = bson.objectid.ObjectId.from_datetime(add_months(month, 1))
+    ledger_event_types = {event_type.value for event_type in LEDGER_EVENT_TYPES}
+    cursor = db.events.find({"_id": {"$gte": start, "$lt": end}}).sort("_id", pymongo.ASCENDING)
+    count, last_id = 0, None
+    with archive.open_partition("ledger", month) as ledger, archive.open_partition("events", month) as other:
+        while (yield cursor.fetch_next):
+            event = cursor.next_object()
+            (ledger if event["type"] in ledger_event_types else other).write(event)
+            count, last_id = count + 1, event["_id"]
+    # Partitions are on disk now. Only remove what has been archived.
+    if last_id is not None:
+        yield db.events.remove({"_id": {"$gte": start, "$lte": last_id}})
+    return count
+
+
+@tornado.gen.coroutine
+def index_archive(archive):
+    "Rewrites ledger partitions archived before they were indexed by account."
+    for month in archive.get_months("ledger"):
+        with archive.open_partition("ledger", month):
+            pass  # the writer merges the existing partition
+        logging.info("Indexed %s.", "{:%Y-%m}".format(month))
+
+
+def get_month(date):
+    "Gets the first moment of the month."
+    return datetime.datetime(date.year, date.month, 1)
+
+
+def add_months(month, count):
+    "Shifts the month by the number of months."
+    year, month_index = divmod(month.year * 12 + month.month - 1 + count, 12)
+    return datetime.datetime(year, month_index + 1, 1)
+
+
 # Shared objects.
 # ------------------------------------------------------------------------------
 
@@ -124,6 +476,835 @@ class SystemEventType(enum.Enum):
     SET_EMAIL = 7
 
 
+class IdeaStatus(enum.Enum):
+    "Stored idea status. Follows freeze and close dates, then resolution."
+
+    OPEN = "open"
+    FROZEN = "frozen"
+    CLOSED = "closed"
+    RESOLVED = "resolved"
+
+
+def make_statistics():
+    "Makes empty account statistics."
+    return {"bets": 0, "staked": 0.0, "wins": 0, "won": 0.0}
+
+
+def add_to_statistics(statistics, event_type, coins, count=1):
+    "Adds bets or wins to account statistics. Other event types are ignored."
+    if event_type == SystemEventType.MADE_BET.value:
+        statistics["bets"] += count
+        statistics["staked"] += coins
+    elif event_type == SystemEventType.WIN.value:
+        statistics["wins"] += count
+        statistics["won"] += coins
+
+
+def make_event(event_type, **kwargs):
+    "Makes system event document."
+    return {"type": event_type.value, "kwargs": kwargs}
+
+
+# Caches.
+# ------------------------------------------------------------------------------
+
+class BalanceCache:
+    "Per-process account balance cache with TTL and LRU eviction. Worker processes learn about writes through CacheInvalidator."
+
+    TTL = 60.0  # seconds
+    MAX_SIZE = 10000  # entries
+
+    def __init__(self, ttl=TTL, max_size=MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # account ID -> (expiration time, coins)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, account_id):
+        "Gets cached balance or None."
+        entry = self.entries.get(account_id)
+        if entry is not None and entry[0] < time.monotonic():
+            del self.entries[account_id]
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(account_id)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, account_id, coins):
+        "Caches balance."
+        self.entries[account_id] = (time.monotonic() + self.ttl, coins)
+        self.entries.move_to_end(account_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, account_id):
+        "Drops cached balance."
+        self.entries.pop(account_id, None)
+
+    def get_statistics(self):
+        "Gets cache counters."
+        return {"size": len(self.entries), "hits": self.hits, "misses": self.misses}
+
+
+class Leaderboard:
+    "Per-process top of accounts by balance, updated incrementally."
+
+    SIZE = 100  # displayed entries
+    CAPACITY = 200  # tracked entries
+    TTL = 60.0  # seconds, picks up changes missed by CacheInvalidator
+
+    def __init__(self, size=SIZE, capacity=CAPACITY, ttl=TTL):
+        self.size = size
+        self.capacity = capacity
+        self.ttl = ttl
+        self.entries = {}  # account ID -> account document
+        self.floor = None  # no untracked account has more coins; None until loaded
+        self.expiration_time = 0.0
+        self.top = None
+
+    def is_valid(self):
+        "Gets whether the tracked entries can be used."
+        if self.floor is None or self.expiration_time < time.monotonic():
+            return False
+        return len(self.entries) >= self.size or self.floor == float("-inf")
+
+    @tornado.gen.coroutine
+    def load(self, db):
+        "Loads top accounts."
+        accounts = yield db.accounts.find({}, {"nickname": True, "coins": True}).\
+            sort("coins", pymongo.DESCENDING).\
+            limit(self.capacity).\
+            to_list(self.capacity)
+        self.entries = {account["_id"]: account for account in accounts}
+        self.floor = accounts[-1]["coins"] if len(accounts) == self.capacity else float("-inf")
+        self.expiration_time = time.monotonic() + self.ttl
+        self.top = None
+
+    def update(self, account_id, nickname, coins):
+        "Updates account balance."
+        if self.floor is None:
+            return
+        self.top = None
+        if coins < self.floor:
+            # The account falls among untracked ones.
+            self.entries.pop(account_id, None)
+            return
+        self.entries[account_id] = {"_id": account_id, "nickname": nickname, "coins": coins}
+        if len(self.entries) > self.capacity:
+            evicted = min(self.entries.values(), key=operator.itemgetter("coins"))
+            del self.entries[evicted["_id"]]
+            self.floor = max(self.floor, evicted["coins"])
+
+    def get_top(self):
+        "Gets top accounts."
+        if self.top is None:
+            self.top = sorted(self.entries.values(), key=operator.itemgetter("coins"), reverse=True)[:self.size]
+        return self.top
+
+    def get_rank(self, account_id):
+        "Gets 1-based account rank if the account is in the top."
+        for rank, account in enumerate(self.get_top(), 1):
+            if account["_id"] == account_id:
+                return rank
+        return None
+
+
+class PageCache:
+    "Per-process rendered page cache for anonymous visitors with TTL, LRU eviction by size and tag invalidation."
+
+    TTL = 10.0  # seconds, bounds staleness in other processes
+    MAX_SIZE = 16 * 1024 * 1024  # bytes
+
+    def __init__(self, ttl=TTL, max_size=MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()  # key -> (expiration time, page, tags)
+        self.keys = collections.defaultdict(set)  # tag -> keys
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        "Gets cached page or None."
+        entry = self.entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            self.remove(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, page, tags):
+        "Caches page."
+        self.remove(key)
+        if len(page.body) > self.max_size:
+            return
+        self.entries[key] = (time.monotonic() + self.ttl, page, tags)
+        self.size += len(page.body)
+        for tag in tags:
+            self.keys[tag].add(key)
+        while self.size > self.max_size:
+            self.remove(next(iter(self.entries)))
+
+    def invalidate(self, *tags):
+        "Drops pages with any of the tags."
+        for tag in tags:
+            for key in self.keys.pop(tag, ()):
+                self.remove(key)
+
+    def remove(self, key):
+        "Drops cached page."
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[1].body)
+        for tag in entry[2]:
+            keys = self.keys.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys[tag]
+
+    def get_statistics(self):
+        "Gets cache counters."
+        return {"size": len(self.entries), "bytes": self.size, "hits": self.hits, "misses": self.misses}
+
+
+Page = collections.namedtuple("Page", ["body", "etag"])
+
+
+def get_idea_page_tag(idea_id):
+    "Gets page cache tag of the idea page."
+    return "idea:{}".format(encode_object_id(idea_id))
+
+
+class IdeaCounters:
+    "Per-process idea counts of the list pages, refreshed periodically and after idea writes."
+
+    STATUSES = [None, "all", "unresolved", "closed"]  # None is the home page
+    REFRESH_INTERVAL = 60.0  # seconds, picks up changes missed by CacheInvalidator
+
+    def __init__(self, refresh_interval=REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self.counts = {}  # status -> idea count, empty until refreshed
+        self.is_refreshing = False
+        self.is_stale = False
+
+    def start(self, db):
+        "Starts periodic refreshing."
+        tornado.ioloop.IOLoop.current().add_callback(self.refresh, db)
+        tornado.ioloop.PeriodicCallback(lambda: self.refresh(db), 1000.0 * self.refresh_interval).start()
+
+    @tornado.gen.coroutine
+    def refresh(self, db):
+        "Recounts ideas. Refreshes requested meanwhile are coalesced into one more run."
+        if self.is_refreshing:
+            self.is_stale = True
+            return
+        self.is_refreshing = True
+        try:
+            while True:
+                self.is_stale = False
+                counts = yield [db.ideas.find(get_index_query(status)[0]).count() for status in self.STATUSES]
+                self.counts = dict(zip(self.STATUSES, counts))
+                if not self.is_stale:
+                    break
+        except Exception:
+            logging.exception("Failed to count ideas.")
+        finally:
+            self.is_refreshing = False
+
+
+class CacheInvalidator:
+    "Invalidates caches of this process and, with several worker processes, broadcasts invalidations through a capped collection."
+
+    COLLECTION_SIZE = 16 * 1024 * 1024  # bytes of recent invalidations
+    MESSAGE_SIZE = 1000  # accounts per message, keeps resolutions below the document size limit
+    RETRY_DELAY = 1.0  # seconds before the tailable cursor is reopened
+
+    def __init__(self, db, balance_cache, leaderboard, page_cache, idea_counters, broadcast=False):
+        self.db = db
+        self.balance_cache = balance_cache
+        self.leaderboard = leaderboard
+        self.page_cache = page_cache
+        self.idea_counters = idea_counters
+        self.broadcast = broadcast
+        self.process_id = bson.objectid.ObjectId()  # tells own invalidations apart
+
+    @tornado.gen.coroutine
+    def invalidate(self, accounts=(), tags=(), counters=False):
+        "Invalidates account balances and leaderboard entries, page cache tags and idea counters in every process. Accounts take _id, nickname and coins."
+        accounts = [{"_id": account["_id"], "nickname": account["nickname"], "coins": account["coins"]} for account in accounts]
+        offsets = range(0, len(accounts), self.MESSAGE_SIZE)
+        messages = [{"process_id": self.process_id, "accounts": accounts[offset:offset + self.MESSAGE_SIZE], "tags": [], "counters": False} for offset in offsets]
+        if not messages:
+            messages.append({"process_id": self.process_id, "accounts": [], "tags": [], "counters": False})
+        messages[-1].update(tags=list(tags), counters=counters)
+        for message in messages:
+            yield self.apply(message)
+            if self.broadcast:
+                yield self.db.invalidations.insert(message)
+
+    @tornado.gen.coroutine
+    def apply(self, message):
+        "Applies invalidation to caches of this process."
+        for account in message["accounts"]:
+            self.balance_cache.invalidate(account["_id"])
+            self.leaderboard.update(account["_id"], account["nickname"], account["coins"])
+        self.page_cache.invalidate(*message["tags"])
+        if message["counters"]:
+            yield self.idea_counters.refresh(self.db)
+
+    @tornado.gen.coroutine
+    def start(self):
+        "Creates the capped collection and starts applying invalidations of other processes."
+        if not self.broadcast:
+            return
+        try:
+            yield self.db.create_collection("invalidations", capped=True, size=self.COLLECTION_SIZE)
+        except (pymongo.errors.CollectionInvalid, pymongo.errors.OperationFailure):
+            pass  # created by another process
+        tornado.ioloop.IOLoop.current().add_callback(self.listen)
+
+    @tornado.gen.coroutine
+    def listen(self):
+        "Tails invalidations of other processes. Replayed invalidations are harmless."
+        since = datetime.datetime.utcnow()
+        while True:
+            try:
+                cursor = self.db.invalidations.find(
+                    {"_id": {"$gte": bson.objectid.ObjectId.from_datetime(since)}},
+                    tailable=True,
+                    await_data=True,
+                )
+                while cursor.alive:
+                    if not (yield cursor.fetch_next):
+                        continue
+                    message = cursor.next_object()
+                    since = message["_id"].generation_time.replace(tzinfo=None)
+                    if message["process_id"] != self.process_id:
+                        yield self.apply(message)
+            except Exception:
+                logging.exception("Failed to read cache invalidations.")
+            # The cursor dies while the collection is empty.
+            future = tornado.concurrent.Future()
+            tornado.ioloop.IOLoop.current().call_later(self.RETRY_DELAY, future.set_result, None)
+            yield future
+
+
+# Idea scheduler.
+# ------------------------------------------------------------------------------
+
+IDEA_SCHEDULE_FIELDS = {"status": True, "freeze_date": True, "close_date": True, "resolved": True}
+
+
+def get_idea_status(idea, now):
+    "Computes idea status from its dates. Takes IDEA_SCHEDULE_FIELDS."
+    if idea.get("resolved"):
+        return IdeaStatus.RESOLVED
+    if now >= idea["close_date"]:
+        return IdeaStatus.CLOSED
+    if now >= idea["freeze_date"]:
+        return IdeaStatus.FROZEN
+    return IdeaStatus.OPEN
+
+
+def get_next_transition_date(idea):
+    "Gets date of the next scheduled status transition or None."
+    if idea["status"] == IdeaStatus.OPEN.value:
+        return idea["freeze_date"]
+    if idea["status"] == IdeaStatus.FROZEN.value:
+        return idea["close_date"]
+    return None
+
+
+class IdeaScheduler:
+    "Flips stored idea status at freeze and close dates. Every process runs its own scheduler."
+
+    def __init__(self, db, cache_invalidator):
+        self.db = db
+        self.cache_invalidator = cache_invalidator
+        self.heap = []  # (transition date, idea ID)
+        self.timeout = None
+        self.timeout_date = None
+
+    @tornado.gen.coroutine
+    def start(self):
+        "Schedules unfinished ideas. Transitions missed while stopped run right away."
+        cursor = self.db.ideas.find({"status": {"$in": [IdeaStatus.OPEN.value, IdeaStatus.FROZEN.value]}}, IDEA_SCHEDULE_FIELDS)
+        count = 0
+        while (yield cursor.fetch_next):
+            self.schedule(cursor.next_object())
+            count += 1
+        logging.info("Scheduled %d ideas.", count)
+
+    def schedule(self, idea):
+        "Schedules the next transition of the idea. Takes IDEA_SCHEDULE_FIELDS."
+        date = get_next_transition_date(idea)
+        if date is None:
+            return
+        heapq.heappush(self.heap, (date, idea["_id"]))
+        if self.timeout_date is None or date < self.timeout_date:
+            self.reset_timeout()
+
+    def reset_timeout(self):
+        "Sets the timeout for the earliest transition."
+        io_loop = tornado.ioloop.IOLoop.current()
+        if self.timeout is not None:
+            io_loop.remove_timeout(self.timeout)
+        self.timeout = self.timeout_date = None
+        if self.heap:
+            self.timeout_date = self.heap[0][0]
+            delay = (self.timeout_date - datetime.datetime.utcnow()).total_seconds()
+            self.timeout = io_loop.add_timeout(io_loop.time() + max(delay, 0.0), self.on_timeout)
+
+    def on_timeout(self):
+        "Runs due transitions."
+        self.timeout = self.timeout_date = None
+        now = datetime.datetime.utcnow()
+        while self.heap and self.heap[0][0] <= now:
+            _, idea_id = heapq.heappop(self.heap)
+            tornado.ioloop.IOLoop.current().add_future(self.transition(idea_id), self.check_transition)
+        self.reset_timeout()
+
+    def check_transition(self, future):
+        "Logs a failed transition."
+        if future.exception() is not None:
+            logging.error("Failed to run idea transition: %s", future.exception())
+
+    @tornado.gen.coroutine
+    def transition(self, idea_id):
+        "Flips idea status if its date has passed, then schedules the next transition."
+        idea = yield self.db.ideas.find_one({"_id": idea_id}, IDEA_SCHEDULE_FIELDS)
+        if not idea:
+            return
+        status = get_idea_status(idea, datetime.datetime.utcnow())
+        if status.value != idea["status"]:
+            # Only the process which flips the status runs the hooks.
+            updated_idea = yield self.db.ideas.find_and_modify(
+                {"_id": idea_id, "status": idea["status"]},
+                {"$set": {"status": status.value}, "$inc": {"version": 1}},
+                fields={"title": True},
+                new=True,
+            )
+            if updated_idea:
+                yield self.on_transition(updated_idea, status)
+                yield self.cache_invalidator.invalidate(tags=[get_idea_page_tag(idea_id), "ideas"], counters=True)
+            idea["status"] = status.value
+        self.schedule(idea)
+
+    @tornado.gen.coroutine
+    def on_transition(self, idea, status):
+        "Runs once per transition."
+        logging.info("Idea %s is %s.", idea["_id"], status.value)
+        if status == IdeaStatus.CLOSED:
+            yield self.notify_admins(idea)
+
+    @tornado.gen.coroutine
+    def notify_admins(self, idea):
+        "Asks admins with confirmed email addresses to resolve the idea."
+        admins = yield self.db.accounts.find(
+            {"_id": {"$in": list(config.ADMIN_ID)}, "confirmed": True},
+            {"email": True},
+        ).to_list(len(config.ADMIN_ID))
+        for admin in admins:
+            yield enqueue_mail(
+                self.db,
+                admin["email"],
+                "WoT Ideas: событие ожидает решения",
+                "Событие «{}» завершено: {}/i/{}".format(idea["title"], config.URL, encode_object_id(idea["_id"])),
+            )
+
+
+# Mail queue.
+# ------------------------------------------------------------------------------
+
+@tornado.gen.coroutine
+def enqueue_mail(db, to, subject, body):
+    "Puts a message into the outgoing mail queue."
+    yield db.mail.insert({
+        "to": to,
+        "subject": subject,
+        "body": body,
+        "status": "pending",
+        "attempts": 0,
+        "next_attempt": datetime.datetime.utcnow(),
+    })
+
+
+class MailQueue:
+    "Drains the outgoing mail queue in the background."
+
+    BATCH_SIZE = 50  # messages claimed per run
+    CONCURRENCY = 4  # messages sent at once
+    MAX_ATTEMPTS = 5  # before a message is dead-lettered
+    RETRY_DELAY = datetime.timedelta(minutes=1)  # doubles with every attempt
+    CLAIM_TIMEOUT = datetime.timedelta(minutes=10)  # claims of crashed senders expire
+
+    def __init__(self, db, pool):
+        self.db = db
+        self.pool = pool
+        self.is_draining = False
+
+    def start(self):
+        "Starts periodic draining."
+        tornado.ioloop.PeriodicCallback(self.drain, config.EMAIL_CALLBACK_TIME).start()
+
+    @tornado.gen.coroutine
+    def drain(self):
+        "Sends due messages."
+        if self.is_draining:
+            return
+        self.is_draining = True
+        try:
+            yield self.release_expired_claims()
+            messages = yield self.claim()
+            for offset in range(0, len(messages), self.CONCURRENCY):
+                yield [self.send(message) for message in messages[offset:offset + self.CONCURRENCY]]
+        except Exception:
+            logging.exception("Failed to drain mail queue.")
+        finally:
+            self.is_draining = False
+
+    @tornado.gen.coroutine
+    def release_expired_claims(self):
+        "Returns messages claimed by a crashed sender to the queue."
+        yield self.db.mail.update(
+            {"status": "sending", "claimed": {"$lt": datetime.datetime.utcnow() - self.CLAIM_TIMEOUT}},
+            {"$set": {"status": "pending"}},
+            multi=True,
+        )
+
+    @tornado.gen.coroutine
+    def claim(self):
+        "Claims a batch of due messages."
+        messages = []
+        while len(messages) < self.BATCH_SIZE:
+            now = datetime.datetime.utcnow()
+            message = yield self.db.mail.find_and_modify(
+                {"status": "pending", "next_attempt": {"$lte": now}},
+                {"$set": {"status": "sending", "claimed": now}},
+                sort=[("next_attempt", pymongo.ASCENDING)],
+                new=True,
+            )
+            if not message:
+                break
+            messages.append(message)
+        return messages
+
+    @tornado.gen.coroutine
+    def send(self, message):
+        "Sends the message and records the outcome."
+        try:
+            yield self.pool.sendmail(email.utils.parseaddr(config.FROM)[1], [message["to"]], self.format(message))
+        except Exception as exception:
+            yield self.fail(message, exception)
+        else:
+            yield self.db.mail.update({"_id": message["_id"]}, {"$set": {
+                "status": "sent",
+                "sent": datetime.datetime.utcnow(),
+            }})
+
+    @tornado.gen.coroutine
+    def fail(self, message, exception):
+        "Schedules a retry or dead-letters the message."
+        attempts = message["attempts"] + 1
+        if attempts < self.MAX_ATTEMPTS:
+            logging.warning("Failed to send message %s (attempt %d): %s", message["_id"], attempts, exception)
+            update = {
+                "status": "pending",
+                "next_attempt": datetime.datetime.utcnow() + self.RETRY_DELAY * 2 ** (attempts - 1),
+            }
+        else:
+            logging.error("Giving up on message %s: %s", message["_id"], exception)
+            update = {"status": "dead"}
+        update.update(attempts=attempts, error=str(exception))
+        yield self.db.mail.update({"_id": message["_id"]}, {"$set": update})
+
+    def format(self, message):
+        "Formats the message as MIME text."
+        mime_message = email.mime.text.MIMEText(message["body"], "plain", "utf-8")
+        mime_message["Subject"] = message["subject"]
+        mime_message["From"] = config.FROM
+        mime_message["Reply-To"] = config.REPLY_TO
+        mime_message["To"] = message["to"]
+        return mime_message.as_string()
+
+
+# Event writer.
+# ------------------------------------------------------------------------------
+
+class EventWriter:
+    "Write-behind event buffer flushed with unordered bulk inserts."
+
+    MAX_SIZE = 500  # buffered events that trigger a flush
+    FLUSH_DELAY = 0.1  # seconds an event may wait in the buffer
+    MAX_PENDING = 5000  # buffered events beyond which writers wait for a flush
+
+    def __init__(self, db, max_size=MAX_SIZE, flush_delay=FLUSH_DELAY, max_pending=MAX_PENDING):
+        self.db = db
+        self.max_size = max_size
+        self.flush_delay = flush_delay
+        self.max_pending = max_pending
+        self.events = []
+        self.timeout = None
+        self.flushing = None  # future of the flush in progress
+
+    @tornado.gen.coroutine
+    def write(self, event):
+        "Buffers the event. Waits while Mongo is behind."
+        # The ID is the log time and keeps the order of buffered events.
+        event.setdefault("_id", bson.objectid.ObjectId())
+        self.events.append(event)
+        if len(self.events) >= self.max_size and self.flushing is None:
+            self.flush_in_background()
+        elif self.timeout is None:
+            self.schedule_flush()
+        while len(self.events) >= self.max_pending:
+            yield self.flush()
+
+    @tornado.gen.coroutine
+    def flush(self):
+        "Writes buffered events. Failed events are put back into the buffer."
+        if self.timeout is not None:
+            tornado.ioloop.IOLoop.current().remove_timeout(self.timeout)
+            self.timeout = None
+        while self.flushing is not None:
+            yield self.flushing
+        if not self.events:
+            return
+        events, self.events = self.events, []
+        self.flushing = tornado.concurrent.Future()
+        try:
+            bulk = self.db.events.initialize_unordered_bulk_op()
+            for event in events:
+                bulk.insert(event)
+            yield bulk.execute()
+        except pymongo.errors.BulkWriteError as exception:
+            # Duplicate IDs are events written by a previous attempt.
+            errors = [error for error in exception.details["writeErrors"] if error["code"] != DUPLICATE_KEY_ERROR]
+            if errors:
+                logging.error("Dropped %d events: %s", len(errors), errors[0]["errmsg"])
+        except Exception:
+            self.events[:0] = events
+            if self.timeout is None:
+                self.schedule_flush()
+            raise
+        finally:
+            flushing, self.flushing = self.flushing, None
+            flushing.set_result(None)
+
+    def schedule_flush(self):
+        "Flushes the buffer after the delay."
+        io_loop = tornado.ioloop.IOLoop.current()
+        self.timeout = io_loop.add_timeout(io_loop.time() + self.flush_delay, self.on_timeout)
+
+    def on_timeout(self):
+        self.timeout = None
+        self.flush_in_background()
+
+    def flush_in_background(self):
+        "Flushes the buffer without waiting for it."
+        tornado.ioloop.IOLoop.current().add_future(self.flush(), self.check_flush)
+
+    def check_flush(self, future):
+        "Logs a failed background flush."
+        if future.exception() is not None:
+            logging.error("Failed to flush %d events: %s", len(self.events), future.exception())
+
+
+# Event archive.
+# ------------------------------------------------------------------------------
+
+class EventArchive:
+    "Old events in monthly gzipped JSON lines partitions. Ledger events are kept apart from the rest and indexed by account."
+
+    PATH = "archive"
+    RETENTION_MONTHS = 6  # months of events kept in the database
+
+    def __init__(self, path=PATH):
+        self.path = pathlib.Path(path)
+
+    def get_partition_path(self, kind, month):
+        "Gets partition path. Kind is either ledger or events."
+        return self.path / "{}-{:%Y-%m}.jsonl.gz".format(kind, month)
+
+    def get_index_path(self, month):
+        "Gets ledger partition index path."
+        return self.path / "ledger-{:%Y-%m}.index".format(month)
+
+    def get_months(self, kind):
+        "Gets archived months, newest first."
+        if not self.path.exists():
+            return []
+        paths = self.path.glob("{}-*.jsonl.gz".format(kind))
+        return sorted((datetime.datetime.strptime(path.name[len(kind) + 1:-len(".jsonl.gz")], "%Y-%m") for path in paths), reverse=True)
+
+    def open_partition(self, kind, month):
+        "Opens partition for writing."
+        if not self.path.exists():
+            self.path.mkdir(parents=True)
+        if kind == "ledger":
+            return LedgerPartitionWriter(self.get_partition_path(kind, month), self.get_index_path(month))
+        return PartitionWriter(self.get_partition_path(kind, month))
+
+    def read_partition(self, kind, month):
+        "Reads partition events ordered by ID."
+        return sorted(read_partition(self.get_partition_path(kind, month)), key=operator.itemgetter("_id"))
+
+    def read_ledger_events(self, month, account_id):
+        "Reads account events of the ledger partition ordered by ID. Only the account member is read when the partition is indexed."
+        path = self.get_partition_path("ledger", month)
+        try:
+            location = find_ledger_member(self.get_index_path(month), path, account_id)
+        except ValueError:
+            logging.warning("Scanning unindexed partition %s. Run --index-archive.", path)
+            return [event for event in self.read_partition("ledger", month) if event["kwargs"]["account_id"] == account_id]
+        if location is None:
+            return []
+        offset, size = location
+        with path.open("rb") as file:
+            file.seek(offset)
+            data = gzip.decompress(file.read(size))
+        return [bson.json_util.loads(line) for line in data.decode("utf-8").splitlines()]
+
+    def find_ledger_events(self, account_id, before=None):
+        "Iterates over archived account ledger events older than the given ID, newest first."
+        for month in self.get_months("ledger"):
+            for event in reversed(self.read_ledger_events(month, account_id)):
+                if before is None or event["_id"] < before:
+                    yield event
+
+    def iter_ledger_events(self):
+        "Iterates over all archived ledger events."
+        for month in self.get_months("ledger"):
+            yield from read_partition(self.get_partition_path("ledger", month))
+
+
+def read_partition(path):
+    "Reads partition events. Missing partitions are empty."
+    if not path.exists():
+        return []
+    with gzip.open(str(path), "rt", encoding="utf-8") as file:
+        return [bson.json_util.loads(line) for line in file]
+
+
+class PartitionWriter:
+    "Writes archive partition atomically. Events already in the partition are kept."
+
+    def __init__(self, path):
+        self.path = path
+        self.temporary_path = path.with_name(path.name + ".tmp")
+        self.ids = set()
+
+    def __enter__(self):
+        self.raw_file = self.temporary_path.open("wb")
+        self.file = io.TextIOWrapper(gzip.GzipFile(fileobj=self.raw_file, mode="wb"), encoding="utf-8")
+        # Merge with a partition left by an interrupted run.
+        for event in read_partition(self.path):
+            self.write(event)
+        return self
+
+    def write(self, event):
+        "Writes the event unless it is already there."
+        if event["_id"] in self.ids:
+            return
+        self.ids.add(event["_id"])
+        self.file.write(bson.json_util.dumps(event))
+        self.file.write("\n")
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        self.raw_file.flush()
+        os.fsync(self.raw_file.fileno())
+        self.raw_file.close()
+        if exc_type is None and self.ids:
+            os.replace(str(self.temporary_path), str(self.path))
+        else:
+            self.temporary_path.unlink()
+
+
+LEDGER_INDEX_MAGIC = b"WIL1"
+LEDGER_INDEX_HEADER = struct.Struct(">4sQ")  # magic, partition size
+LEDGER_INDEX_RECORD = struct.Struct(">qQQ")  # account ID, member offset, member size; sorted by account ID
+
+
+class LedgerPartitionWriter(PartitionWriter):
+    "Writes ledger partition as one gzip member per account, and the index of the members. Keeps the month in memory."
+
+    def __init__(self, path, index_path):
+        super().__init__(path)
+        self.index_path = index_path
+        self.temporary_index_path = index_path.with_name(index_path.name + ".tmp")
+        self.events = collections.defaultdict(list)
+
+    def __enter__(self):
+        # Merge with a partition left by an interrupted run.
+        for event in read_partition(self.path):
+            self.write(event)
+        return self
+
+    def write(self, event):
+        "Writes the event unless it is already there."
+        if event["_id"] in self.ids:
+            return
+        self.ids.add(event["_id"])
+        self.events[event["kwargs"]["account_id"]].append(event)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None or not self.ids:
+            return
+        records = []
+        with self.temporary_path.open("wb") as file:
+            for account_id, events in sorted(self.events.items()):
+                events.sort(key=operator.itemgetter("_id"))
+                member = gzip.compress("".join(bson.json_util.dumps(event) + "\n" for event in events).encode("utf-8"))
+                records.append(LEDGER_INDEX_RECORD.pack(account_id, file.tell(), len(member)))
+                file.write(member)
+            size = file.tell()
+            file.flush()
+            os.fsync(file.fileno())
+        with self.temporary_index_path.open("wb") as file:
+            file.write(LEDGER_INDEX_HEADER.pack(LEDGER_INDEX_MAGIC, size))
+            file.write(b"".join(records))
+            file.flush()
+            os.fsync(file.fileno())
+        # The index names the partition size, so readers ignore it if a crash comes between the renames.
+        os.replace(str(self.temporary_path), str(self.path))
+        os.replace(str(self.temporary_index_path), str(self.index_path))
+
+
+def find_ledger_member(index_path, partition_path, account_id):
+    "Finds the account member of the ledger partition by binary search in the index. Returns its offset and size, or None. Raises ValueError if the partition is not indexed."
+    try:
+        file = index_path.open("rb")
+    except FileNotFoundError as exception:
+        raise ValueError("no index") from exception
+    with file:
+        magic, partition_size = LEDGER_INDEX_HEADER.unpack(file.read(LEDGER_INDEX_HEADER.size))
+        if magic != LEDGER_INDEX_MAGIC or partition_size != partition_path.stat().st_size:
+            raise ValueError("stale index")
+        low, high = 0, (os.fstat(file.fileno()).st_size - LEDGER_INDEX_HEADER.size) // LEDGER_INDEX_RECORD.size
+        while low < high:
+            middle = (low + high) // 2
+            file.seek(LEDGER_INDEX_HEADER.size + middle * LEDGER_INDEX_RECORD.size)
+            record_account_id, offset, size = LEDGER_INDEX_RECORD.unpack(file.read(LEDGER_INDEX_RECORD.size))
+            if record_account_id < account_id:
+                low = middle + 1
+            elif record_account_id > account_id:
+                high = middle
+            else:
+                return offset, size
+    return None
+
+
 # Base request handler.
 # ------------------------------------------------------------------------------
 
@@ -140,14 +1321,88 @@ def decode_object_id(urlsafe_id):
         raise ValueError("invalid ID") from exception
 
 
+SESSION_VERSION = 1
+SESSION_HEADER = struct.Struct(">BQ")  # version, account ID; followed by UTF-8 nickname
+LEGACY_SESSION_PREFIX = b"\x80"  # pickle protocol opcode
+
+
+def encode_session(user):
+    "Encodes user into a session cookie value."
+    try:
+        header = SESSION_HEADER.pack(SESSION_VERSION, user.account_id)
+    except struct.error as exception:
+        raise ValueError("invalid account ID: {}".format(user.account_id)) from exception
+    return header + user.nickname.encode("utf-8")
+
+
+def decode_session(value):
+    "Decodes session cookie value into a user."
+    if len(value) < SESSION_HEADER.size or value[0] != SESSION_VERSION:
+        raise ValueError("unsupported session")
+    _, account_id = SESSION_HEADER.unpack_from(value)
+    return User(account_id, value[SESSION_HEADER.size:].decode("utf-8"))
+
+
+class LegacySessionUnpickler(pickle.Unpickler):
+    "Unpickles legacy session cookies. Only the User class may be loaded."
+
+    def find_class(self, module, name):
+        if module in ("__main__", __name__) and name == "User":
+            return User
+        raise pickle.UnpicklingError("forbidden global: {}.{}".format(module, name))
+
+
+def decode_legacy_session(value):
+    "Decodes pickled session cookie value into a user."
+    try:
+        user = LegacySessionUnpickler(io.BytesIO(value)).load()
+    except (pickle.UnpicklingError, EOFError, TypeError) as exception:
+        raise ValueError("invalid legacy session") from exception
+    if not isinstance(user, User):
+        raise ValueError("invalid legacy session")
+    return user
+
+
+def encode_cursor(document, sort_by):
+    "Encodes the document sort key into an opaque URL-safe page cursor."
+    data = bson.BSON.encode({"k": sort_by, "v": document[sort_by], "i": document["_id"]})
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor, sort_by):
+    "Decodes page cursor into the sort field value and object ID."
+    try:
+        document = bson.BSON(base64.urlsafe_b64decode(cursor.encode("ascii"))).decode()
+    except bson.errors.BSONError as exception:
+        raise ValueError("invalid cursor") from exception
+    # Both sort keys are dates. Anything else could inject query operators.
+    if (
+        document.get("k") != sort_by or
+        not isinstance(document.get("v"), datetime.datetime) or
+        not isinstance(document.get("i"), bson.objectid.ObjectId)
+    ):
+        raise ValueError("invalid cursor")
+    return document["v"], document["i"]
+
+
 def is_idea_frozen(idea):
-    "Gets whether the idea is frozen."
-    return datetime.datetime.utcnow() >= idea["freeze_date"]
+    "Gets whether the idea is frozen. Closed and resolved ideas are frozen too."
+    return idea["status"] != IdeaStatus.OPEN.value
 
 
 def is_idea_closed(idea):
-    "Gets whether the idea is closed."
-    return datetime.datetime.utcnow() >= idea["close_date"]
+    "Gets whether the idea is closed. Resolved ideas are closed too."
+    return idea["status"] in (IdeaStatus.CLOSED.value, IdeaStatus.RESOLVED.value)
+
+
+def get_idea_state(idea):
+    "Gets idea state shown on pages. Takes IDEA_STATE_FIELDS."
+    return (idea["_id"], idea.get("version", 0), idea["status"])
+
+
+def make_etag(*parts):
+    "Makes strong ETag from the page state."
+    return '"{}"'.format(hashlib.sha1(repr(parts).encode("utf-8")).hexdigest())
 
 
 def format_date(date):
@@ -157,6 +1412,9 @@ def format_date(date):
 
 class RequestHandler(tornado.web.RequestHandler):
     "Base request handler."
+
+    page_cache_key = None  # set when the response goes into the page cache
+    page_etag = None
     
     @tornado.gen.coroutine
     def prepare(self):
@@ -166,11 +1424,57 @@ class RequestHandler(tornado.web.RequestHandler):
         self.now = datetime.datetime.utcnow()
         # Admin stuff.
         self.is_admin = (self.current_user is not None) and (self.current_user.account_id in config.ADMIN_ID)
+        # Anonymous pages.
+        if self.current_user is None and self.request.method == "GET":
+            self.page_cache_tags = self.get_page_cache_tags(*self.path_args)
+            if self.page_cache_tags is not None:
+                page = self.settings["page_cache"].get(self.request.uri)
+                if page is not None:
+                    if page.etag is not None and self.check_etag(page.etag):
+                        self.finish()
+                    else:
+                        self.finish(page.body)
+                    return
+                self.page_cache_key = self.request.uri
+
+    def get_page_cache_tags(self, *args):
+        "Gets page cache tags of the anonymous page. None means the page is not cached."
+        return None
+
+    def finish(self, chunk=None):
+        "Finishes the request. Rendered anonymous pages are cached."
+        if self.page_cache_key is not None and chunk is not None and self.get_status() == http.client.OK:
+            self.settings["page_cache"].set(self.page_cache_key, Page(tornado.escape.utf8(chunk), self.page_etag), self.page_cache_tags)
+        return super().finish(chunk)
+
+    def make_page_etag(self, *parts):
+        "Makes page ETag from the page state and the header state."
+        return make_etag(self.current_user, self.balance, self.is_admin, self.settings["idea_counters"].counts, *parts)
+
+    def check_etag(self, etag):
+        "Sets the ETag. Answers Not Modified and returns True if the client has the page already."
+        self.page_etag = etag
+        self.set_header("Etag", etag)
+        if not self.check_etag_header():
+            return False
+        self.set_status(http.client.NOT_MODIFIED)
+        return True
 
     def get_current_user(self):
         "Gets current user."
         cookie = self.get_secure_cookie("user")
-        return pickle.loads(cookie) if (cookie is not None) else None
+        if cookie is None:
+            return None
+        try:
+            if not cookie.startswith(LEGACY_SESSION_PREFIX):
+                return decode_session(cookie)
+            user = decode_legacy_session(cookie)
+        except ValueError:
+            logging.warning("Invalid session cookie.")
+            return None
+        # Migrate legacy session.
+        self.set_secure_cookie("user", encode_session(user))
+        return user
 
     def get_template_namespace(self):
         "Gets default template namespace."
@@ -180,6 +1484,7 @@ class RequestHandler(tornado.web.RequestHandler):
             "current_user": self.current_user,  # header
             "encode_object_id": encode_object_id,  # index
             "format_date": format_date,
+            "idea_counts": self.settings["idea_counters"].counts,  # header
             "is_admin": self.is_admin,
             "is_idea_closed": is_idea_closed,
             "is_idea_frozen": is_idea_frozen,
@@ -189,21 +1494,27 @@ class RequestHandler(tornado.web.RequestHandler):
     @tornado.gen.coroutine
     def get_balance(self):
         "Gets current user balance string."
-        account = yield self.db.accounts.find_one({"_id": self.current_user.account_id}, {"coins": True})
-        return int(account["coins"])
+        balance_cache = self.settings["balance_cache"]
+        coins = balance_cache.get(self.current_user.account_id)
+        if coins is None:
+            account = yield self.db.accounts.find_one({"_id": self.current_user.account_id}, {"coins": True})
+            coins = account["coins"]
+            balance_cache.set(self.current_user.account_id, coins)
+        return int(coins)
 
     @tornado.gen.coroutine
-    def get_unresolved_idea_count(self):
-        "Gets unresolved idea count for the header link."
-        return (yield self.db.ideas.find({
-            "resolved": False,
-            "close_date": {"$lt": self.now}
-        }).count())
+    def log_event(self, event_type, *, sync=False, **kwargs):
+        "Logs system event. Goes through the event writer if there is one and sync is not set."
+        yield self.write_event(make_event(event_type, **kwargs), sync)
 
     @tornado.gen.coroutine
-    def log_event(self, event_type, **kwargs):
-        "Logs system event."
-        yield self.db.events.insert({"type": event_type.value, "kwargs": kwargs})
+    def write_event(self, event, sync=False):
+        "Writes event document. Goes through the event writer if there is one and sync is not set."
+        event_writer = self.settings["event_writer"]
+        if event_writer is None or sync:
+            yield self.db.events.insert(event)
+        else:
+            yield event_writer.write(event)
 
     def handle_bad_request(self):
         logging.exception("Invalid request.")
@@ -213,46 +1524,75 @@ class RequestHandler(tornado.web.RequestHandler):
 # Index handler.
 # ------------------------------------------------------------------------------
 
+IDEA_LIST_FIELDS = {"title": True, "description": True, "freeze_date": True, "close_date": True, "status": True}  # used by index.html
+IDEA_STATE_FIELDS = {"version": True, "status": True}  # used by get_idea_state
+
+
+def get_index_query(status, excluded_idea_ids=None, after=None):
+    "Gets idea list query spec and sort order for the status view, starting after the cursor if given."
+    spec = {}
+    if status == "unresolved":
+        sort_by, direction = "close_date", pymongo.ASCENDING
+        spec["status"] = IdeaStatus.CLOSED.value
+    elif status == "closed":
+        sort_by, direction = "close_date", pymongo.DESCENDING
+        spec["status"] = IdeaStatus.RESOLVED.value
+    elif status == "all":
+        sort_by, direction = "freeze_date", pymongo.DESCENDING
+    else:
+        sort_by, direction = "freeze_date", pymongo.ASCENDING
+        spec["status"] = IdeaStatus.OPEN.value
+        if excluded_idea_ids is not None:
+            spec["_id"] = {"$nin": excluded_idea_ids}
+    if after is not None:
+        value, _id = decode_cursor(after, sort_by)
+        operator = "$gt" if direction == pymongo.ASCENDING else "$lt"
+        spec["$or"] = [{sort_by: {operator: value}}, {sort_by: value, "_id": {operator: _id}}]
+    return spec, sort_by, direction
+
+
 class IndexRequestHandler(RequestHandler):
     "Home page handler."
 
     PAGE_SIZE = 10  # idea page size
 
+    def get_page_cache_tags(self, status=None):
+        return ["ideas"]
+
     @tornado.gen.coroutine
     def get(self, status=None):
+        after = self.get_query_argument("after", None)
+        excluded_idea_ids = (yield self.get_bet_idea_ids()) if (status is None and self.current_user) else None
         try:
-            page = self.parse_arguments()
+            spec, sort_by, direction = get_index_query(status, excluded_idea_ids, after)
         except ValueError:
             self.handle_bad_request()
             return
-        spec = {}
-        if status == "unresolved":
-            sort_by, direction = "close_date", pymongo.ASCENDING
-            spec["resolved"] = False
-            spec["close_date"] = {"$lt": self.now}
-        elif status == "closed":
-            sort_by, direction = "close_date", pymongo.DESCENDING
-            spec["resolved"] = True
-            spec["close_date"] = {"$lt": self.now}
-        elif status == "all":
-            sort_by, direction = "freeze_date", pymongo.DESCENDING
-        else:
-            sort_by, direction = "freeze_date", pymongo.ASCENDING
-            spec["freeze_date"] = {"$gt": self.now}
-            if self.current_user:
-                spec["bets.account_id"] = {"$ne": self.current_user.account_id}
-        ideas = yield self.db.ideas.find(spec).\
-            sort(sort_by, direction).\
-            skip((page - 1) * self.PAGE_SIZE).\
-            limit(self.PAGE_SIZE).\
-            to_list(self.PAGE_SIZE)
-        self.render("index.html", ideas=ideas, page=page, path=self.request.path, status=status)
+        # Fetch one extra idea to find out whether there is a next page.
+        states = yield self.db.ideas.find(spec, IDEA_STATE_FIELDS).\
+            sort([(sort_by, direction), ("_id", direction)]).\
+            limit(self.PAGE_SIZE + 1).\
+            to_list(self.PAGE_SIZE + 1)
+        if self.check_etag(self.make_page_etag(status, after, [get_idea_state(state) for state in states])):
+            return
+        ideas = yield self.db.ideas.find(spec, IDEA_LIST_FIELDS).\
+            sort([(sort_by, direction), ("_id", direction)]).\
+            limit(self.PAGE_SIZE + 1).\
+            to_list(self.PAGE_SIZE + 1)
+        next_cursor = encode_cursor(ideas[self.PAGE_SIZE - 1], sort_by) if len(ideas) > self.PAGE_SIZE else None
+        self.render(
+            "index.html",
+            ideas=ideas[:self.PAGE_SIZE],
+            after=after,
+            next_cursor=next_cursor,
+            path=self.request.path,
+            status=status,
+        )
 
-    def parse_arguments(self):
-        page = int(self.get_query_argument("page", 1))
-        if page < 1:
-            raise ValueError("invalid page")
-        return page
+    @tornado.gen.coroutine
+    def get_bet_idea_ids(self):
+        "Gets IDs of ideas the current user has bet on."
+        return (yield self.db.bets.find({"account_id": self.current_user.account_id}).distinct("idea_id"))
 
 
 # Log in handler.
@@ -271,10 +1611,16 @@ class LogInRequestHandler(RequestHandler):
 
     @tornado.gen.coroutine
     def get(self):
+        account_created = False
         if self.get_query_argument("status") == "ok":
-            account_id = int(self.get_query_argument("account_id"))
-            nickname = self.get_query_argument("nickname")
-            self.set_secure_cookie("user", pickle.dumps(User(account_id, nickname)))
+            try:
+                account_id = int(self.get_query_argument("account_id"))
+                nickname = self.get_query_argument("nickname")
+                session = encode_session(User(account_id, nickname))
+            except (ValueError, tornado.web.MissingArgumentError):
+                self.handle_bad_request()
+                return
+            self.set_secure_cookie("user", session)
             account_created = yield self.create_account(account_id, nickname)
             yield self.log_event(SystemEventType.LOGGED_IN, account_id=account_id)
         self.redirect("/" if not account_created else "/profile")
@@ -283,7 +1629,11 @@ class LogInRequestHandler(RequestHandler):
     def create_account(self, account_id, nickname):
         "Creates a new account with initial balance."
         try:
-            yield self.db.accounts.insert({"_id": account_id, "nickname": nickname, "coins": 100.0})
+            yield self.db.accounts.insert({"_id": account_id, "nickname": nickname, "coins": 100.0, "stats": make_statistics()})
+            yield self.settings["cache_invalidator"].invalidate(
+                accounts=[{"_id": account_id, "nickname": nickname, "coins": 100.0}],
+                tags=["accounts"],
+            )
             yield self.log_event(SystemEventType.SET_INITIAL_BALANCE, account_id=account_id, coins=100.0)
         except pymongo.errors.DuplicateKeyError:
             return False
@@ -316,6 +1666,8 @@ class NewRequestHandler(RequestHandler):
             self.handle_bad_request()
         else:
             document_id = yield self.db.ideas.insert(document)
+            self.settings["idea_scheduler"].schedule(document)
+            yield self.settings["cache_invalidator"].invalidate(tags=["ideas"], counters=True)
             self.redirect("/i/{}".format(encode_object_id(document_id)))
 
     def parse_arguments(self):
@@ -348,7 +1700,9 @@ class NewRequestHandler(RequestHandler):
             "freeze_date": freeze_datetime,
             "close_date": close_datetime,
             "resolved": False,
-            "bets": [],
+            "status": IdeaStatus.OPEN.value,
+            "pool": make_pool(),
+            "version": 0,
         }
 
     def parse_datetime(self, date, time):
@@ -359,25 +1713,71 @@ class NewRequestHandler(RequestHandler):
 # Idea handler.
 # ------------------------------------------------------------------------------
 
-def get_bets_budget(bets):
-    "Gets idea bets total sum."
-    return sum(map(operator.itemgetter("coins"), bets))
+def get_pool_side(bet):
+    "Gets idea pool side for the bet value."
+    return "yes" if bet else "no"
+
+
+def make_pool(bets=()):
+    "Makes idea pool counters for the specified bets."
+    pool = {"coins": 0.0, "count": 0, "yes": {"coins": 0.0, "count": 0}, "no": {"coins": 0.0, "count": 0}}
+    for bet in bets:
+        add_to_pool(pool, bet["bet"], bet["coins"])
+    return pool
+
+
+def add_to_pool(pool, bet, coins, count=1):
+    "Adds bets to the pool counters."
+    for counters in (pool, pool[get_pool_side(bet)]):
+        counters["coins"] += coins
+        counters["count"] += count
 
 
 class IdeaRequestHandler(RequestHandler):
     "Idea handler."
 
+    BET_PAGE_SIZE = 50  # bet table page size
+
+    def get_page_cache_tags(self, urlsafe_id):
+        try:
+            return [get_idea_page_tag(decode_object_id(urlsafe_id))]
+        except ValueError:
+            return None
+
     @tornado.gen.coroutine
     def get(self, urlsafe_id):
+        before = self.get_query_argument("before", None)
         try:
             _id = decode_object_id(urlsafe_id)
+            spec = {"idea_id": _id, "pending": {"$exists": False}}
+            if before is not None:
+                spec["_id"] = {"$lt": decode_object_id(before)}
         except ValueError:
             self.handle_bad_request()
             return
+        state = yield self.db.ideas.find_one({"_id": _id}, IDEA_STATE_FIELDS)
+        if not state:
+            self.send_error(http.client.NOT_FOUND)
+            return
+        if self.check_etag(self.make_page_etag(get_idea_state(state), before)):
+            return
         idea = yield self.db.ideas.find_one({"_id": _id})
         if idea:
-            budget = int(get_bets_budget(idea["bets"]))
-            self.render("idea.html", idea=idea, budget=budget, _xsrf=self.xsrf_form_html())
+            # Fetch one extra bet to find out whether there are older bets.
+            bets = yield self.db.bets.find(spec).\
+                sort("_id", pymongo.DESCENDING).\
+                limit(self.BET_PAGE_SIZE + 1).\
+                to_list(self.BET_PAGE_SIZE + 1)
+            next_cursor = encode_object_id(bets[self.BET_PAGE_SIZE - 1]["_id"]) if len(bets) > self.BET_PAGE_SIZE else None
+            self.render(
+                "idea.html",
+                idea=idea,
+                pool=idea["pool"],
+                bets=bets[:self.BET_PAGE_SIZE],
+                before=before,
+                next_cursor=next_cursor,
+                _xsrf=self.xsrf_form_html(),
+            )
         else:
             self.send_error(http.client.NOT_FOUND)
 
@@ -406,62 +1806,234 @@ class BetRequestHandler(RequestHandler):
     def parse_arguments(self):
         bet = bool(int(self.get_argument("bet")))
         coins = float(self.get_argument("coins"))
-        if coins <= 0:
+        if not 0 < coins < float("inf"):
             raise ValueError("invalid coins value: %s" % coins)
+        if to_cents(coins) / CENTS_PER_COIN != coins:
+            raise ValueError("coins value is not in whole cents: %s" % coins)
         return bet, coins
 
     @tornado.gen.coroutine
     def make_bet(self, user, idea_id, bet, coins):
         "Makes a bet."
-        idea = yield self.db.ideas.find_one({"_id": idea_id})
+        idea = yield self.db.ideas.find_one({"_id": idea_id}, {"status": True, "freeze_date": True})
         if not idea:
             raise ValueError("idea not found")
-        if is_idea_frozen(idea):
+        # The scheduler may flip the status a moment late.
+        if is_idea_frozen(idea) or idea["freeze_date"] <= datetime.datetime.utcnow():
             raise ValueError("idea is frozen")
-        account = yield self.db.accounts.find_and_modify(
-            {
-                "_id": user.account_id,
-                "coins": {"$gte": coins},
-            },
-            {"$inc": {"coins": -coins}},
-            new=True,
-        )
+        # The bet is stored first. Everything else is derived from it by apply_bet.
+        document = {
+            "_id": bson.objectid.ObjectId(),
+            "idea_id": idea_id,
+            "account_id": user.account_id,
+            "nickname": user.nickname,
+            "coins": coins,
+            "bet": bet,
+            "pending": True,
+            "owner": bson.objectid.ObjectId(),
+            "lease": datetime.datetime.utcnow() + BET_LEASE_TIME,
+        }
+        yield self.db.bets.insert(document)
+        account = yield apply_bet(self.db, document, self.write_event)
         if not account:
             raise ValueError("not enough coins")
-        yield self.db.ideas.update(
-            {"_id": idea_id},
-            {"$push": {"bets": {"account_id": user.account_id, "nickname": user.nickname, "coins": coins, "bet": bet}}},
-        )
-        yield self.log_event(
-            SystemEventType.MADE_BET,
-            account_id=user.account_id,
-            idea_id=idea_id,
-            bet=bet,
-            coins=coins,
-            balance=account["coins"],
+        yield self.settings["cache_invalidator"].invalidate(accounts=[account], tags=[get_idea_page_tag(idea_id), "accounts"])
+
+
+BET_LEASE_TIME = datetime.timedelta(minutes=1)  # renewed before every step of applying a bet
+
+
+class LeaseLostError(Exception):
+    "Another process has taken the work over after the lease expired."
+
+
+@tornado.gen.coroutine
+def renew_bet_lease(db, bet):
+    "Renews the pending bet lease. Raises LeaseLostError if the bet is no longer ours."
+    result = yield db.bets.update({"_id": bet["_id"], "owner": bet["owner"]}, {"$set": {"lease": datetime.datetime.utcnow() + BET_LEASE_TIME}})
+    if not result["n"]:
+        raise LeaseLostError("bet {} has been taken over".format(bet["_id"]))
+
+
+@tornado.gen.coroutine
+def apply_bet(db, bet, write_event=None):
+    "Debits the account, adds the pending bet to the pool counters and logs it. Pending bet markers make a repeated call by the next lease owner apply nothing twice. Returns the account, or None if it cannot afford the bet, which is then removed."
+    # Debit the account. The lease is renewed before every step which relies on the markers.
+    yield renew_bet_lease(db, bet)
+    account = yield db.accounts.find_and_modify(
+        {"_id": bet["account_id"], "coins": {"$gte": bet["coins"]}, "pending_bets": {"$ne": bet["_id"]}},
+        {
+            "$inc": {"coins": -bet["coins"], "stats.bets": 1, "stats.staked": bet["coins"]},
+            "$push": {"pending_bets": bet["_id"]},
+        },
+        new=True,
+    )
+    if not account:
+        account = yield db.accounts.find_one({"_id": bet["account_id"], "pending_bets": bet["_id"]}, {"nickname": True, "coins": True})
+        if not account:
+            result = yield db.bets.remove({"_id": bet["_id"], "owner": bet["owner"]})
+            if not result["n"]:
+                raise LeaseLostError("bet {} has been taken over".format(bet["_id"]))
+            return None
+    # Update pool counters.
+    yield renew_bet_lease(db, bet)
+    side = get_pool_side(bet["bet"])
+    yield db.ideas.update(
+        {"_id": bet["idea_id"], "pending_bets": {"$ne": bet["_id"]}},
+        {
+            "$inc": {
+                "pool.coins": bet["coins"],
+                "pool.count": 1,
+                "pool.{}.coins".format(side): bet["coins"],
+                "pool.{}.count".format(side): 1,
+                "version": 1,
+            },
+            "$push": {"pending_bets": bet["_id"]},
+        },
+    )
+    # Log the bet. The event shares the bet ID.
+    event = dict(make_event(
+        SystemEventType.MADE_BET,
+        account_id=bet["account_id"],
+        idea_id=bet["idea_id"],
+        bet=bet["bet"],
+        coins=bet["coins"],
+        balance=account["coins"],
+    ), _id=bet["_id"])
+    if write_event is not None:
+        yield write_event(event)
+    else:
+        yield insert_skipping_duplicate(db.events, event)
+    # Markers are not needed once the bet is applied. A process which has lost the lease must not pull them.
+    applied_bet = yield db.bets.find_and_modify(
+        {"_id": bet["_id"], "owner": bet["owner"]},
+        {"$unset": {"pending": True, "owner": True, "lease": True}},
+    )
+    if not applied_bet:
+        raise LeaseLostError("bet {} has been taken over".format(bet["_id"]))
+    yield db.accounts.update({"_id": bet["account_id"]}, {"$pull": {"pending_bets": bet["_id"]}})
+    yield db.ideas.update({"_id": bet["idea_id"]}, {"$pull": {"pending_bets": bet["_id"]}})
+    return account
+
+
+@tornado.gen.coroutine
+def repair_bets(db):
+    "Applies pending bets whose lease has expired, which crashed requests leave behind. Returns repaired bets and their accounts."
+    repaired_bets = []
+    while True:
+        now = datetime.datetime.utcnow()
+        bet = yield db.bets.find_and_modify(
+            {"pending": True, "lease": {"$not": {"$gt": now}}},
+            {"$set": {"owner": bson.objectid.ObjectId(), "lease": now + BET_LEASE_TIME}},
+            new=True,
         )
+        if not bet:
+            return repaired_bets
+        logging.warning("Repairing bet %s…", bet["_id"])
+        account = yield apply_bet(db, bet)
+        repaired_bets.append((bet, account))
 
 
 # Balance handler.
 # ------------------------------------------------------------------------------
 
+LEDGER_EVENT_TYPES = [
+    SystemEventType.SET_INITIAL_BALANCE,
+    SystemEventType.MADE_BET,
+    SystemEventType.WIN,
+]
+
+
+def get_ledger_query(account_id, before=None):
+    "Gets account ledger events query spec, optionally for events older than the given ID."
+    spec = {
+        "kwargs.account_id": account_id,
+        "type": {"$in": [event_type.value for event_type in LEDGER_EVENT_TYPES]},
+    }
+    if before is not None:
+        spec["_id"] = {"$lt": before}
+    return spec
+
+
 class BalanceRequestHandler(RequestHandler):
     "User balance handler."
 
+    PAGE_SIZE = 100  # events per page
+
     @tornado.gen.coroutine
     def get(self):
         if not self.current_user:
             self.redirect("/")
-        spec = {
-            "kwargs.account_id": self.current_user.account_id,
-            "type": {"$in": [
-                SystemEventType.SET_INITIAL_BALANCE.value,
-                SystemEventType.MADE_BET.value,
-                SystemEventType.WIN.value,
-            ]}
-        }
-        events = yield self.db.events.find(spec).sort("_id", pymongo.DESCENDING).to_list(100)
-        self.render("balance.html", events=events)
+            return
+        try:
+            before = self.get_query_argument("before", None)
+            spec = get_ledger_query(self.current_user.account_id, decode_object_id(before) if before else None)
+        except ValueError:
+            self.handle_bad_request()
+            return
+        # Fetch one extra event to find out whether there is a next page.
+        events = yield self.db.events.find(spec).\
+            sort("_id", pymongo.DESCENDING).\
+            limit(self.PAGE_SIZE + 1).\
+            to_list(self.PAGE_SIZE + 1)
+        if len(events) <= self.PAGE_SIZE:
+            # Archived events are older than any event in the database.
+            archived_events = self.settings["event_archive"].find_ledger_events(self.current_user.account_id, spec.get("_id", {}).get("$lt"))
+            events.extend(itertools.islice(archived_events, self.PAGE_SIZE + 1 - len(events)))
+        next_before = encode_object_id(events[self.PAGE_SIZE - 1]["_id"]) if len(events) > self.PAGE_SIZE else None
+        self.render("balance.html", events=events[:self.PAGE_SIZE], before=before, next_before=next_before)
+
+
+class BalanceExportRequestHandler(RequestHandler):
+    "User ledger CSV export handler."
+
+    CHUNK_SIZE = 1000  # rows per flush
+
+    @tornado.gen.coroutine
+    def get(self):
+        if not self.current_user:
+            self.redirect("/")
+            return
+        self.set_header("Content-Type", "text/csv; charset=utf-8")
+        self.set_header("Content-Disposition", "attachment; filename=balance.csv")
+        cursor = self.db.events.find(get_ledger_query(self.current_user.account_id)).\
+            sort("_id", pymongo.DESCENDING).\
+            batch_size(self.CHUNK_SIZE)
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(["date", "type", "coins", "balance", "idea"])
+        row_count = 0
+        while (yield cursor.fetch_next):
+            writer.writerow(self.get_row(cursor.next_object()))
+            row_count += 1
+            if row_count % self.CHUNK_SIZE == 0:
+                yield self.write_chunk(buffer)
+        for event in self.settings["event_archive"].find_ledger_events(self.current_user.account_id):
+            writer.writerow(self.get_row(event))
+            row_count += 1
+            if row_count % self.CHUNK_SIZE == 0:
+                yield self.write_chunk(buffer)
+        yield self.write_chunk(buffer)
+
+    def get_row(self, event):
+        "Gets CSV row for the ledger event."
+        kwargs = event["kwargs"]
+        idea_id = kwargs.get("idea_id")
+        return [
+            event["_id"].generation_time.strftime("%Y-%m-%d %H:%M:%S"),
+            SystemEventType(event["type"]).name,
+            "{:.2f}".format(kwargs["coins"]),
+            "{:.2f}".format(kwargs["balance"]) if "balance" in kwargs else "",
+            encode_object_id(idea_id) if idea_id else "",
+        ]
+
+    @tornado.gen.coroutine
+    def write_chunk(self, buffer):
+        "Sends buffered rows to the client."
+        self.write(buffer.getvalue())
+        buffer.seek(0)
+        buffer.truncate()
+        yield self.flush()
 
 
 # Balance handler.
@@ -474,34 +2046,23 @@ class ProfileRequestHandler(RequestHandler):
     def get(self):
         if not self.current_user:
             self.redirect("/")
+            return
         profile = yield self.db.accounts.find_one({"_id": self.current_user.account_id})
-        statistics = yield self.get_statistics()
+        # Accounts bet on before --rebuild-statistics have partial or no statistics.
+        statistics = make_statistics()
+        statistics.update(profile.get("stats", {}))
         self.render("profile.html", profile=profile, statistics=statistics, _xsrf=self.xsrf_form_html())
 
     @tornado.gen.coroutine
     def post(self):
         if not self.current_user:
             self.handle_bad_request()
+            return
         email = self.get_argument("email")
         if email:
             yield self.set_email(email)
         self.redirect("/profile")
 
-    @tornado.gen.coroutine
-    def get_statistics(self):
-        "Gets profile statistics."
-        result = yield self.db.events.aggregate([
-            {
-                "$match": {
-                    "kwargs.account_id": self.current_user.account_id,
-                    "type": {"$in": [SystemEventType.MADE_BET.value, SystemEventType.WIN.value]},
-                }
-            },
-            {"$group": {"_id": "$type", "count": {"$sum": 1}, "coins": {"$sum": "$kwargs.coins"}}},
-        ])
-        return collections.defaultdict(lambda: collections.defaultdict(int),
-            {SystemEventType(doc["_id"]): doc for doc in result["result"]})
-
     @tornado.gen.coroutine
     def set_email(self, email):
         yield self.db.accounts.update({"_id": self.current_user.account_id}, {"$set": {
@@ -509,6 +2070,33 @@ class ProfileRequestHandler(RequestHandler):
             "confirmed": False,
         }})
         yield self.log_event(SystemEventType.SET_EMAIL, account_id=self.current_user.account_id, email=email)
+        token = self.create_signed_value("confirm", "{} {}".format(self.current_user.account_id, email))
+        url = "{}/confirm?token={}".format(config.URL, tornado.escape.url_escape(token))
+        yield enqueue_mail(
+            self.db,
+            email,
+            "WoT Ideas: подтверждение адреса",
+            "Чтобы подтвердить адрес, перейдите по ссылке: {}".format(url),
+        )
+
+
+# Email confirmation handler.
+# ------------------------------------------------------------------------------
+
+class ConfirmRequestHandler(RequestHandler):
+    "Email confirmation handler."
+
+    MAX_AGE_DAYS = 7  # token lifetime
+
+    @tornado.gen.coroutine
+    def get(self):
+        value = self.get_secure_cookie("confirm", value=self.get_query_argument("token"), max_age_days=self.MAX_AGE_DAYS)
+        if value is None:
+            self.send_error(http.client.BAD_REQUEST)
+            return
+        account_id, email = value.decode("utf-8").split(" ", 1)
+        yield self.db.accounts.update({"_id": int(account_id), "email": email}, {"$set": {"confirmed": True}})
+        self.redirect("/profile")
 
 
 # Account list handler.
@@ -517,19 +2105,31 @@ class ProfileRequestHandler(RequestHandler):
 class AccountsRequestHandler(RequestHandler):
     "Account list handler."
 
-    LIMIT = 100
+    def get_page_cache_tags(self):
+        return ["accounts"]
 
     @tornado.gen.coroutine
     def get(self):
-        accounts = yield self.db.accounts.find().sort("coins", pymongo.DESCENDING).limit(self.LIMIT).to_list(self.LIMIT)
-        self.render("accounts.html", accounts=accounts)
+        leaderboard = self.settings["leaderboard"]
+        if not leaderboard.is_valid():
+            yield leaderboard.load(self.db)
+        rank = None
+        if self.current_user:
+            rank = leaderboard.get_rank(self.current_user.account_id) or (yield self.get_rank())
+        self.render("accounts.html", accounts=leaderboard.get_top(), rank=rank)
+
+    @tornado.gen.coroutine
+    def get_rank(self):
+        "Gets current user rank outside of the top."
+        account = yield self.db.accounts.find_one({"_id": self.current_user.account_id}, {"coins": True})
+        return (yield self.db.accounts.find({"coins": {"$gt": account["coins"]}}).count()) + 1
 
 
 # Resolve handler.
 # ------------------------------------------------------------------------------
 
 class ResolveRequestHandler(RequestHandler):
-    "Resolve handler."
+    "Resolve handler. Resolution runs as a background job."
 
     @tornado.gen.coroutine
     def prepare(self):
@@ -537,16 +2137,36 @@ class ResolveRequestHandler(RequestHandler):
         if not self.is_admin:
             self.send_error(http.client.UNAUTHORIZED)
 
+    @tornado.gen.coroutine
+    def get(self, urlsafe_id):
+        "Gets resolution job progress."
+        try:
+            idea_id = decode_object_id(urlsafe_id)
+        except ValueError:
+            self.handle_bad_request()
+            return
+        job = yield self.db.resolutions.find_one({"_id": idea_id})
+        if not job:
+            self.send_error(http.client.NOT_FOUND)
+            return
+        self.write({
+            "state": job["state"],
+            "prize_count": job["prize_count"],
+            "paid_count": job["paid_count"],
+        })
+
     @tornado.gen.coroutine
     def post(self, urlsafe_id):
         try:
             idea_id = decode_object_id(urlsafe_id)
             resolution, proof = self.parse_arguments()
-            yield self.resolve(idea_id, resolution, proof)
+            yield create_resolution(self.db, idea_id, resolution, proof)
         except (ValueError, tornado.web.MissingArgumentError):
             self.handle_bad_request()
             return
         else:
+            yield self.settings["cache_invalidator"].invalidate(tags=[get_idea_page_tag(idea_id)])
+            tornado.ioloop.IOLoop.current().add_callback(self.settings["resolver"].run)
             self.redirect("/i/{}".format(urlsafe_id))
 
     def parse_arguments(self):
@@ -556,52 +2176,336 @@ class ResolveRequestHandler(RequestHandler):
             raise ValueError("empty proof")
         return resolution, proof
 
+
+class Resolver:
+    "Runs resolution jobs and repairs pending bets in the background. Jobs of a crashed process are resumed when their lease expires."
+
+    INTERVAL = 10.0  # seconds between job checks
+    LEASE_TIME = datetime.timedelta(minutes=1)  # renewed on every checkpoint
+
+    def __init__(self, db, cache_invalidator):
+        self.db = db
+        self.cache_invalidator = cache_invalidator
+        self.is_running = False
+        self.is_stale = False
+
+    def start(self):
+        "Starts periodic job checks."
+        tornado.ioloop.IOLoop.current().add_callback(self.run)
+        tornado.ioloop.PeriodicCallback(self.run, 1000.0 * self.INTERVAL).start()
+
     @tornado.gen.coroutine
-    def resolve(self, idea_id, resolution, proof):
-        "Resolves idea."
-        idea = yield self.db.ideas.find_one({"_id": idea_id})
-        if not idea:
-            raise ValueError("idea not found")
-        # Start updating coins.
-        yield self.log_event(SystemEventType.IDEA_RESOLVING, idea_id=idea_id)
-        # Get prizes.
-        prizes = get_prizes(idea["bets"], resolution)
-        for prize in prizes:
-            # Update coins.
-            account = yield self.db.accounts.find_and_modify(
-                {"_id": prize.account_id},
-                {"$inc": {"coins": prize.coins}},
-                new=True,
-            )
-            # Log event.
-            yield self.log_event(
-                SystemEventType.WIN,
-                account_id=prize.account_id,
-                coins=prize.coins,
-                balance=account["coins"],
-                idea_id=idea_id,
-            )
-        # Resolve idea.
-        yield self.db.ideas.update({"_id": idea_id}, {"$set": {
-            "resolved": True,
-            "resolution": resolution,
-            "proof": proof,
-        }})
-        # Finish updating coins.
-        yield self.log_event(SystemEventType.IDEA_RESOLVED, idea_id=idea_id)
+    def run(self):
+        "Runs jobs until there are none. Runs requested meanwhile are coalesced into one more check."
+        if self.is_running:
+            self.is_stale = True
+            return
+        self.is_running = True
+        try:
+            yield self.repair_bets()
+            while True:
+                self.is_stale = False
+                job = yield self.claim()
+                if job:
+                    yield self.process(job)
+                elif not self.is_stale:
+                    break
+        except Exception:
+            logging.exception("Failed to run resolution job.")
+        finally:
+            self.is_running = False
+
+    @tornado.gen.coroutine
+    def repair_bets(self):
+        "Repairs pending bets and invalidates caches."
+        for bet, account in (yield repair_bets(self.db)):
+            if account:
+                yield self.cache_invalidator.invalidate(accounts=[account], tags=[get_idea_page_tag(bet["idea_id"]), "accounts"])
+
+    @tornado.gen.coroutine
+    def claim(self):
+        "Claims an unfinished job which nobody is working on."
+        now = datetime.datetime.utcnow()
+        return (yield self.db.resolutions.find_and_modify(
+            {"state": {"$in": ["pending", "paying"]}, "lease": {"$lt": now}},
+            {"$set": {"lease": now + self.LEASE_TIME, "lease_owner": bson.objectid.ObjectId()}},
+            new=True,
+        ))
+
+    @tornado.gen.coroutine
+    def process(self, job):
+        "Runs the job and invalidates caches."
+        logging.info("Resolving idea %s…", job["_id"])
+        accounts = yield run_resolution(self.db, job, self.checkpoint)
+        yield self.cache_invalidator.invalidate(accounts=accounts, tags=[get_idea_page_tag(job["_id"]), "ideas", "accounts"], counters=True)
+        logging.info("Resolved idea %s.", job["_id"])
+
+    @tornado.gen.coroutine
+    def checkpoint(self, job):
+        "Saves progress and renews the lease. Raises LeaseLostError if another process has claimed the job meanwhile."
+        result = yield self.db.resolutions.update(
+            {"_id": job["_id"], "lease_owner": job["lease_owner"]},
+            {"$set": dict(get_resolution_progress(job), lease=datetime.datetime.utcnow() + self.LEASE_TIME)},
+        )
+        if not result["n"]:
+            raise LeaseLostError("resolution {} has been claimed by another process".format(job["_id"]))
+
+
+RESOLUTION_CHUNK_SIZE = 1000  # prizes stored or paid per checkpoint
+DUPLICATE_KEY_ERROR = 11000
+
+
+def get_resolution_progress(job):
+    "Gets resolution job fields saved on checkpoints."
+    return {"state": job["state"], "prize_count": job["prize_count"], "paid_count": job["paid_count"]}
+
+
+@tornado.gen.coroutine
+def create_resolution(db, idea_id, resolution, proof):
+    "Creates resolution job of the closed idea."
+    idea = yield db.ideas.find_one({"_id": idea_id}, {"status": True})
+    if not idea:
+        raise ValueError("idea not found")
+    if idea["status"] != IdeaStatus.CLOSED.value:
+        raise ValueError("idea is not closed")
+    job = {
+        "_id": idea_id,
+        "resolution": resolution,
+        "proof": proof,
+        "state": "pending",
+        "lease": datetime.datetime.utcnow(),
+        "prize_count": None,
+        "paid_count": 0,
+    }
+    try:
+        yield db.resolutions.insert(job)
+    except pymongo.errors.DuplicateKeyError as exception:
+        raise ValueError("idea is being resolved") from exception
+    yield db.ideas.update({"_id": idea_id}, {"$set": {"resolving": True}, "$inc": {"version": 1}})
+    yield log_idea_event_once(db, SystemEventType.IDEA_RESOLVING, idea_id)
+    return job
+
+
+@tornado.gen.coroutine
+def resolve_idea(db, idea_id, resolution, proof):
+    "Resolves idea in place without the background resolver. Returns paid accounts."
+    job = yield create_resolution(db, idea_id, resolution, proof)
+    return (yield run_resolution(db, job))
+
+
+@tornado.gen.coroutine
+def run_resolution(db, job, checkpoint=None, chunk_size=RESOLUTION_CHUNK_SIZE):
+    "Pays prizes out chunk by chunk, then resolves the idea. Safe to rerun after a crash. The checkpoint saves progress and must fail once the job has been taken over. Returns paid accounts."
+    idea_id = job["_id"]
+    if checkpoint is None:
+        # Resolving in place: nobody else runs the job.
+        checkpoint = lambda job: db.resolutions.update({"_id": job["_id"]}, {"$set": get_resolution_progress(job)})
+    if job["prize_count"] is None:
+        job["prize_count"] = yield store_prizes(db, idea_id, job["resolution"], lambda: checkpoint(job), chunk_size)
+        job["state"] = "paying"
+    paid_accounts = {}
+    while True:
+        # Payout markers stay until the job is done, so the chunk is paid once as long as the job is still ours.
+        yield checkpoint(job)
+        prizes = yield db.prizes.find({"idea_id": idea_id, "paid": False}).\
+            sort("_id", pymongo.ASCENDING).\
+            limit(chunk_size).\
+            to_list(chunk_size)
+        if not prizes:
+            break
+        accounts = yield pay_prizes(db, idea_id, prizes)
+        paid_accounts.update((account["_id"], account) for account in accounts)
+        job["paid_count"] = yield db.prizes.find({"idea_id": idea_id, "paid": True}).count()
+        logging.info("Paid %d of %d prizes.", job["paid_count"], job["prize_count"])
+    yield db.ideas.update({"_id": idea_id}, {
+        "$set": {"resolved": True, "status": IdeaStatus.RESOLVED.value, "resolution": job["resolution"], "proof": job["proof"]},
+        "$unset": {"resolving": True},
+        "$inc": {"version": 1},
+    })
+    yield log_idea_event_once(db, SystemEventType.IDEA_RESOLVED, idea_id)
+    job["state"] = "done"
+    yield checkpoint(job)
+    # A done job is never run again, so the markers are not needed anymore.
+    yield db.accounts.update({"payouts.i": idea_id}, {"$pull": {"payouts": {"i": idea_id}}}, multi=True)
+    return list(paid_accounts.values())
+
+
+@tornado.gen.coroutine
+def store_prizes(db, idea_id, resolution, renew_lease, chunk_size=RESOLUTION_CHUNK_SIZE):
+    "Stores per-account prizes of the winning bets, renewing the job lease on the way. Prizes are keyed by idea and account, so a rerun stores nothing twice. Returns prize count."
+    # Bets are the source of truth. Pending ones must be applied or dropped first.
+    yield repair_bets(db)
+    yield renew_lease()
+    if (yield db.bets.find({"idea_id": idea_id, "pending": True}).count()):
+        raise ValueError("idea has pending bets")
+    result = yield db.bets.aggregate([
+        {"$match": {"idea_id": idea_id}},
+        {"$group": {"_id": "$bet", "coins": {"$sum": "$coins"}, "count": {"$sum": 1}}},
+    ])
+    pool = make_pool()
+    for doc in result["result"]:
+        add_to_pool(pool, doc["_id"], doc["coins"], doc["count"])
+    idea = yield db.ideas.find_one({"_id": idea_id}, {"pool": True})
+    if get_pool_key(idea["pool"]) != get_pool_key(pool):
+        logging.error("Pool counters of idea %s are %r, bets add up to %r. Paying by the bets.", idea_id, idea["pool"], pool)
+        yield db.ideas.update({"_id": idea_id}, {"$set": {"pool": pool}, "$inc": {"version": 1}})
+    winners = []
+    cursor = db.bets.find({"idea_id": idea_id, "bet": resolution}, {"_id": False, "account_id": True, "coins": True, "bet": True})
+    while (yield cursor.fetch_next):
+        winners.append(cursor.next_object())
+    prizes = get_prizes(winners, resolution, pool)
+    for offset in range(0, len(prizes), chunk_size):
+        yield renew_lease()
+        bulk = db.prizes.initialize_unordered_bulk_op()
+        for prize in prizes[offset:offset + chunk_size]:
+            bulk.insert({
+                "_id": {"i": idea_id, "a": prize.account_id},
+                "idea_id": idea_id,
+                "account_id": prize.account_id,
+                "coins": prize.coins,
+                "event_id": bson.objectid.ObjectId(),  # WIN event ID
+                "paid": False,
+            })
+        yield execute_skipping_duplicates(bulk)
+    return len(prizes)
+
+
+@tornado.gen.coroutine
+def pay_prizes(db, idea_id, prizes):
+    "Pays stored prizes out with bulk writes. Per-account payout markers, which are kept until the job is done, make a repeated call pay nothing twice. Returns paid accounts."
+    # Update coins and mark prizes paid within the same account update.
+    bulk = db.accounts.initialize_unordered_bulk_op()
+    for prize in prizes:
+        bulk.find({"_id": prize["account_id"], "payouts": {"$ne": prize["_id"]}}).update_one({
+            "$inc": {"coins": prize["coins"], "stats.wins": 1, "stats.won": prize["coins"]},
+            "$push": {"payouts": prize["_id"]},
+        })
+    yield bulk.execute()
+    # Read new balances back in one query.
+    account_ids = list(set(prize["account_id"] for prize in prizes))
+    accounts = yield db.accounts.find({"_id": {"$in": account_ids}}, {"nickname": True, "coins": True}).to_list(len(account_ids))
+    balances = {account["_id"]: account["coins"] for account in accounts}
+    # Log events. Walk the chunk backwards to restore per-prize balances.
+    bulk = db.events.initialize_unordered_bulk_op()
+    for prize in reversed(prizes):
+        bulk.insert(dict(make_event(
+            SystemEventType.WIN,
+            account_id=prize["account_id"],
+            coins=prize["coins"],
+            balance=balances[prize["account_id"]],
+            idea_id=idea_id,
+        ), _id=prize["event_id"]))
+        balances[prize["account_id"]] -= prize["coins"]
+    yield execute_skipping_duplicates(bulk)
+    yield db.prizes.update({"_id": {"$in": [prize["_id"] for prize in prizes]}}, {"$set": {"paid": True}}, multi=True)
+    return accounts
 
 
-def get_prizes(bets, resolution):
-    "Gets idea prizes for the specified bets and resolution."
+@tornado.gen.coroutine
+def execute_skipping_duplicates(bulk):
+    "Executes bulk insert. Documents inserted by a previous run are skipped."
+    try:
+        yield bulk.execute()
+    except pymongo.errors.BulkWriteError as exception:
+        if exception.details["writeConcernErrors"] or any(
+            error["code"] != DUPLICATE_KEY_ERROR for error in exception.details["writeErrors"]
+        ):
+            raise
+
+
+@tornado.gen.coroutine
+def insert_skipping_duplicate(collection, document):
+    "Inserts document unless a previous run has inserted it."
+    try:
+        yield collection.insert(document)
+    except pymongo.errors.DuplicateKeyError:
+        pass
+
+
+@tornado.gen.coroutine
+def log_idea_event_once(db, event_type, idea_id):
+    "Logs idea event unless a previous run has logged it."
+    event = make_event(event_type, idea_id=idea_id)
+    yield db.events.update(event, event, upsert=True)
+
+
+def get_prizes(bets, resolution, pool=None):
+    "Gets per-account idea prizes for the specified bets and resolution. Bets must include every winning bet. Pool counters are computed when not given."
     if not bets:
         logging.info("No bets.")
         return []
+    if pool is None:
+        pool = make_pool(bets)
     winners = [bet for bet in bets if bet["bet"] == resolution]
-    logging.info("Total bets: %d. %d winners.", len(bets), len(winners))
-    total_budget = get_bets_budget(bets)
-    winners_budget = get_bets_budget(winners)
-    logging.info("Total budget: %.2f. Winners budget: %.2f.", total_budget, winners_budget)
-    return [Prize(bet["account_id"], total_budget * bet["coins"] / winners_budget) for bet in winners]
+    logging.info("Total bets: %d. %d winners.", pool["count"], len(winners))
+    logging.info("Total budget: %.2f. Winners budget: %.2f.", pool["coins"], pool[get_pool_side(resolution)]["coins"])
+    account_ids, prizes = compute_prizes(
+        numpy.fromiter((bet["account_id"] for bet in winners), numpy.int64, len(winners)),
+        to_cents(numpy.fromiter((bet["coins"] for bet in winners), numpy.float64, len(winners))),
+        int(to_cents(pool["coins"])),
+    )
+    return [Prize(account_id, prize / CENTS_PER_COIN) for account_id, prize in zip(account_ids.tolist(), prizes.tolist())]
+
+
+CENTS_PER_COIN = 100  # prizes are paid in whole cents
+
+
+def get_pool_key(pool):
+    "Gets pool counters in cents for comparison."
+    return tuple((counters["count"], int(to_cents(counters["coins"]))) for counters in (pool, pool["yes"], pool["no"]))
+
+
+def to_cents(coins):
+    "Converts coins to integer cents."
+    return numpy.rint(numpy.asarray(coins, numpy.float64) * CENTS_PER_COIN).astype(numpy.int64)
+
+
+def compute_prizes(account_ids, stakes, budget):
+    "Splits the budget between accounts in proportion to their total stakes. Works in cents: shares are rounded down and the remaining cents go to the largest remainders. Returns account IDs and prizes, none when the stakes add up to nothing."
+    if not len(account_ids):
+        return account_ids, stakes
+    # Combine bets per account.
+    order = numpy.argsort(account_ids)
+    account_ids, stakes = account_ids[order], stakes[order]
+    is_first = numpy.ones(len(account_ids), bool)
+    is_first[1:] = account_ids[1:] != account_ids[:-1]
+    starts = numpy.flatnonzero(is_first)
+    account_ids, stakes = account_ids[starts], numpy.add.reduceat(stakes, starts)
+    # budget * stake = quotient * stake * winners_budget + remainder * stake, which keeps products within int64.
+    winners_budget = int(stakes.sum())
+    if not winners_budget:
+        # Stakes below a cent: there is nothing to split the budget by.
+        return account_ids[:0], stakes[:0]
+    quotient, remainder = divmod(budget, winners_budget)
+    if winners_budget >= 2 ** 31:
+        stakes = stakes.astype(object)
+    products = remainder * stakes
+    prizes = (quotient * stakes + products // winners_budget).astype(numpy.int64)
+    remainders = products % winners_budget
+    # Rounded down shares leave fewer cents than there are accounts.
+    leftover = budget - int(prizes.sum())
+    # Ties go to lower account IDs.
+    prizes[numpy.argsort(-remainders, kind="mergesort")[:leftover]] += 1
+    return account_ids, prizes
+
+
+# Statistics handler.
+# ------------------------------------------------------------------------------
+
+class StatsRequestHandler(RequestHandler):
+    "Process statistics handler."
+
+    @tornado.gen.coroutine
+    def prepare(self):
+        yield super().prepare()
+        if not self.is_admin:
+            self.send_error(http.client.UNAUTHORIZED)
+
+    def get(self):
+        self.write({
+            "balance_cache": self.settings["balance_cache"].get_statistics(),
+            "page_cache": self.settings["page_cache"].get_statistics(),
+        })
 
 
 # Log out handler.